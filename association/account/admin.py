@@ -1,5 +1,9 @@
+import datetime
+
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.db import models
+from django.db.models import OuterRef, Subquery
 from django.utils.translation import ugettext_lazy as _
 
 from .models import User, PaymentsUser
@@ -28,28 +32,33 @@ class UserAdminNew(UserAdmin):
         SubTest
     ]
 
+    def get_queryset(self, request):
+        """
+        Annotate each user with his last validate payment, so the changelist is rendered with a single query.
+        """
+        payments = PaymentsUser.objects.filter(user=OuterRef("pk"), status="is_paid",
+                                               subscribed_until__gte=datetime.date.today()).order_by("-id")
+        return super().get_queryset(request).annotate(
+            last_product=Subquery(payments.values("product__name")[:1], output_field=models.CharField()),
+            last_subscription=Subquery(payments.values("subscription__name")[:1], output_field=models.CharField()),
+            last_subscribed_until=Subquery(payments.values("subscribed_until")[:1], output_field=models.DateField()),
+        )
+
     def product(self, user):
-        product = user.get_product()
-        if product is not None:
-            product = product.name
-        return product
+        return user.last_product
 
     def subscription(self, user):
-        subscription = user.get_subscription()
-        if subscription is not None:
-            subscription = subscription.name
-        return subscription
+        return user.last_subscription
 
     def subscribed_until(self, user):
-        payment = user.get_last_validate_payment()
-        if payment is not None:
-            payment = payment.subscribed_until
-            return payment
-        return None
+        return user.last_subscribed_until
 
     product.name = 'Name'
     subscription.name = 'Name'
     subscribed_until.name = 'Name'
+    product.admin_order_field = 'last_product'
+    subscription.admin_order_field = 'last_subscription'
+    subscribed_until.admin_order_field = 'last_subscribed_until'
 
 
 admin.site.register(User, UserAdminNew)
@@ -1,8 +1,11 @@
+from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseRedirect
+from django.db.models import Q
+from django.http import HttpResponseRedirect, Http404
 from django.shortcuts import resolve_url
+from django.utils.dateparse import parse_date
 
 DEFAULT_PAGE = "dashboard"
 
@@ -32,9 +35,10 @@ class AccreditationViewRequiredMixin(LoginRequiredMixin):
         """
         Customized method that checks the accreditation.
         """
-        if self.strict and request.user.accreditation == self.accreditation:
+        accreditation = request.user.effective_accreditation
+        if self.strict and accreditation == self.accreditation:
             return True
-        elif not self.strict and request.user.accreditation >= self.accreditation:
+        elif not self.strict and accreditation >= self.accreditation:
             return True
         # In case the 403 handler should be called raise the exception
         if self.raise_exception:
@@ -61,7 +65,8 @@ def accreditation_view_required(perm=1, strict=False, redirect_url=None, raise_e
             return True
         elif not user.is_authenticated:
             return False
-        if (strict and user.accreditation == perm) or (not strict and user.accreditation >= perm):
+        accreditation = user.effective_accreditation
+        if (strict and accreditation == perm) or (not strict and accreditation >= perm):
             return True
         # In case the 403 handler should be called raise the exception
         if raise_exception:
@@ -69,3 +74,96 @@ def accreditation_view_required(perm=1, strict=False, redirect_url=None, raise_e
         # As the last resort, show the login form
         return False
     return user_passes_test(check_perms, login_url=redirect_url)
+
+
+class KeysetPage(object):
+    """
+    A page of KeysetPaginationMixin, with the attributes of the pages of Django used by the templates.
+    The cursors of the previous and next pages are the keys of its first and last rows.
+    """
+
+    def __init__(self, object_list, has_next, has_previous, count=None):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.count = count  # Rows of all the pages, None when not counted
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self._has_next else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self._has_previous else None
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+
+def encode_cursor(obj):
+    return "%s_%d" % (obj.date.isoformat(), obj.pk)
+
+
+def decode_cursor(cursor):
+    """
+    :return: (date, pk) of a cursor made by encode_cursor()
+    :raise Http404: If the cursor is invalid
+    """
+    try:
+        date, pk = cursor.split("_")
+        date, pk = parse_date(date), int(pk)
+    except ValueError:
+        date = None
+    if date is None:
+        raise Http404("Invalid cursor %r" % cursor)
+    return date, pk
+
+
+class KeysetPaginationMixin(object):
+    """
+    ListView mixin which pages the rows newest first by (date, id), with the cursors ?after= and ?before=.
+    A page is read after the last row of the previous one instead of after an OFFSET, so its cost doesn't depend on
+    its position. The rows are counted only if count is True, one row more than the page tells if there is a next one.
+    """
+    page_size = None  # Rows per page, settings.PAGE_SIZE by default, can be lowered by ?size=
+    count = None  # Count the rows of all the pages in page_obj.count, settings.PAGE_COUNT by default
+
+    def get_paginate_by(self, queryset):
+        page_size = self.page_size or settings.PAGE_SIZE
+        try:
+            return max(1, min(int(self.request.GET.get("size", page_size)), settings.MAX_PAGE_SIZE))
+        except ValueError:
+            return page_size
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        :return: (paginator, page, object_list, is_paginated), like MultipleObjectMixin.paginate_queryset()
+        """
+        count = queryset.count() if (settings.PAGE_COUNT if self.count is None else self.count) else None
+        after, before = self.request.GET.get("after"), self.request.GET.get("before")
+        if before:
+            date, pk = decode_cursor(before)
+            rows = list(queryset.filter(Q(date__gt=date) | Q(date=date, pk__gt=pk))
+                                .order_by("date", "pk")[:page_size + 1])
+            page = KeysetPage(rows[:page_size][::-1], has_next=bool(rows), has_previous=len(rows) > page_size,
+                              count=count)
+        else:
+            if after:
+                date, pk = decode_cursor(after)
+                queryset = queryset.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+            rows = list(queryset.order_by("-date", "-pk")[:page_size + 1])
+            page = KeysetPage(rows[:page_size], has_next=len(rows) > page_size, has_previous=bool(after and rows),
+                              count=count)
+        return None, page, page.object_list, page.has_other_pages()
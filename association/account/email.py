@@ -1,16 +1,197 @@
-from django.core.mail import EmailMessage
+import datetime
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
 from django.template.loader import render_to_string
+from django.utils import timezone, translation
+
+from .models import OutgoingEmail
+
+
+class MailReport(object):
+    """
+    Summary of a run of send_mass_mail_template()
+    """
+
+    def __init__(self, messages=0, sent=0, seconds=0.0, errors=None):
+        self.messages = messages  # Messages to send
+        self.sent = sent  # Messages accepted by the backend
+        self.seconds = seconds
+        self.errors = errors or []  # (addresses, exception) of the batches which failed
+
+    @property
+    def rate(self):
+        """
+        Messages sent per second
+        """
+        if self.seconds:
+            return self.sent / self.seconds
+        return 0.0
+
+    def __repr__(self):
+        return "<MailReport messages=%d sent=%d errors=%d seconds=%.3f rate=%.1f/s>" % (
+            self.messages, self.sent, len(self.errors), self.seconds, self.rate)
+
+
+def queue_mail(subject, body, to):
+    """
+    Queue an email, sent in background by the send_mails command: the views don't wait for the SMTP server.
+
+    :param to: List of addresses
+    :return: The OutgoingEmail
+    """
+    return OutgoingEmail.objects.create(subject=subject, body=body, to=",".join(to))
 
 
 def send_register_mail(link, name, email, association):
     subject = "Your ask for registration on %s." % association
     context = {'link_id': link, 'name': name}
     template = render_to_string("account/register_mail.html", context)
-    EmailMessage(subject, template, to=[email]).send()
+    queue_mail(subject, template, to=[email])
 
 
 def send_reset_password_mail(link, name, email, association):
     subject = "Your ask for reset your password on %s" % association
     context = {'link_id': link, 'name': name}
     template = render_to_string("account/forgot_password__mail.html", context)
-    EmailMessage(subject, template, to=[email]).send()
+    queue_mail(subject, template, to=[email])
+
+
+def claim_queued_mails(batch_size):
+    """
+    Take the oldest pending emails of the queue, and the ones left by a worker which didn't finish them:
+    they are marked SENDING until settings.EMAIL_CLAIM_TIMEOUT, so another worker doesn't send them too.
+
+    :return: The list of OutgoingEmail claimed
+    """
+    now = timezone.now()
+    until = now + datetime.timedelta(seconds=settings.EMAIL_CLAIM_TIMEOUT)
+    due = OutgoingEmail.objects.filter(status__in=(OutgoingEmail.PENDING, OutgoingEmail.SENDING),
+                                       next_attempt__lte=now)
+    with transaction.atomic():
+        pks = list(due.select_for_update().order_by("id").values_list("pk", flat=True)[:batch_size])
+        # The filter is applied again: a row claimed meanwhile by another worker isn't due anymore
+        due.filter(pk__in=pks).update(status=OutgoingEmail.SENDING, next_attempt=until)
+    return list(OutgoingEmail.objects.filter(pk__in=pks, status=OutgoingEmail.SENDING, next_attempt=until)
+                                     .order_by("id"))
+
+
+def record_mail_error(email, error):
+    """
+    Count a failed attempt: the email is tried again after settings.EMAIL_RETRY_DELAY, doubled after each failure,
+    until it fails settings.EMAIL_MAX_ATTEMPTS times.
+    """
+    email.attempts += 1
+    email.error_message = str(error)[:255]
+    if email.attempts >= settings.EMAIL_MAX_ATTEMPTS:
+        email.status = OutgoingEmail.ERROR
+    else:
+        email.status = OutgoingEmail.PENDING
+        delay = settings.EMAIL_RETRY_DELAY * 2 ** (email.attempts - 1)
+        email.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+
+
+def send_queued_mails(batch_size=100, backend=None):
+    """
+    Send the oldest pending emails of the queue, through a single connection.
+    An email which can't be sent, or whose connection can't be opened, is tried again later with a growing delay
+    (see record_mail_error()).
+
+    :param batch_size: Max number of emails to send
+    :param backend: Path of the email backend, settings.EMAIL_BACKEND if None
+    :return: The number of emails taken from the queue
+    """
+    emails = claim_queued_mails(batch_size)
+    if not emails:
+        return 0
+
+    connection = get_connection(backend)
+    try:
+        connection.open()
+    except Exception as error:  # The SMTP server is down: every email of the batch waits for the next attempt
+        for email in emails:
+            record_mail_error(email, error)
+            email.save(update_fields=["status", "attempts", "next_attempt", "error_message"])
+        return len(emails)
+
+    try:
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, to=email.to.split(","), connection=connection)
+            try:
+                message.send()
+            except Exception as error:  # smtplib and socket errors, or anything raised by another backend
+                record_mail_error(email, error)
+            else:
+                email.status = OutgoingEmail.SENT
+                email.sent = timezone.now()
+            email.save(update_fields=["status", "sent", "attempts", "next_attempt", "error_message"])
+    finally:
+        connection.close()
+    return len(emails)
+
+
+def mail_queue_stats():
+    """
+    :return: The number of pending emails, and the age in seconds of the oldest one
+    """
+    pending = OutgoingEmail.objects.filter(status__in=(OutgoingEmail.PENDING, OutgoingEmail.SENDING))
+    oldest = pending.order_by("id").values_list("created", flat=True).first()
+    lag = (timezone.now() - oldest).total_seconds() if oldest is not None else 0.0
+    return {"depth": pending.count(), "lag": lag}
+
+
+def render_mail_per_language(template_name, context, languages):
+    """
+    Render a template once for each language.
+
+    :return: A dict {language: body}
+    """
+    bodies = {}
+    for language in languages:
+        with translation.override(language):
+            bodies[language] = render_to_string(template_name, context)
+    return bodies
+
+
+def send_mass_mail_template(subject, template_name, recipients, context=None, batch_size=None, max_rate=None,
+                            connection=None):
+    """
+    Send the same email to many recipients, each in his language: the template is rendered once per language,
+    and the messages are sent by batches through a single connection, throttled to the provider's limit.
+
+    :param recipients: Iterable of (address, language), the language None for settings.LANGUAGE_CODE
+    :param context: Context of the template, common to every recipient
+    :param batch_size: Messages given at once to the backend, settings.EMAIL_BATCH_SIZE if None
+    :param max_rate: Max messages sent per second, settings.EMAIL_MAX_RATE if None (0 for no limit)
+    :param connection: Connection of the email backend, settings.EMAIL_BACKEND if None
+    :return: A MailReport
+    """
+    batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+    max_rate = settings.EMAIL_MAX_RATE if max_rate is None else max_rate
+    by_language = OrderedDict()
+    for address, language in recipients:
+        by_language.setdefault(language or settings.LANGUAGE_CODE, []).append(address)
+    bodies = render_mail_per_language(template_name, context or {}, by_language)
+    messages = [EmailMessage(subject, bodies[language], to=[address])
+                for language, addresses in by_language.items() for address in addresses]
+
+    report = MailReport(messages=len(messages))
+    start = time.monotonic()
+    connection = connection or get_connection()
+    with connection:
+        for i in range(0, len(messages), batch_size):
+            batch = messages[i:i + batch_size]
+            try:
+                report.sent += connection.send_messages(batch) or 0
+            except Exception as error:  # The rest of the batch isn't sent
+                report.errors.append(([message.to[0] for message in batch], error))
+                connection.close()  # Opened again by the next batch
+            if max_rate:  # Wait until the average rate is under the limit
+                delay = (i + len(batch)) / max_rate - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+    report.seconds = time.monotonic() - start
+    return report
@@ -0,0 +1,217 @@
+import glob
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import zipfile
+
+import django
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import get_template
+from django_weasyprint import WeasyTemplateResponse
+from django_weasyprint.backends import InlineBackend, set_backend
+from django_weasyprint.views import CONTENT_TYPE_PDF
+
+INVOICE_TEMPLATE = "payment/facture.html"
+# Columns read by INVOICE_TEMPLATE, for QuerySet.only() with select_related("user", "product", "subscription")
+INVOICE_FIELDS = ("reference", "date", "status", "price", "tva",
+                  "product", "product__name", "product__recurrent", "subscription", "subscription__name",
+                  "user", "user__username", "user__name", "user__first_name", "user__address", "user__postcode",
+                  "user__city", "user__country")
+
+
+def get_invoice_key(payment, template_name=INVOICE_TEMPLATE, stylesheets=()):
+    """
+    Key of the invoice in the cache, which changes with the template and the stylesheets used to render it.
+
+    :param payment: The PaymentsUser of the invoice
+    :param template_name: The template of the invoice
+    :param stylesheets: The stylesheets of the invoice
+    :return: A hexadecimal digest
+    """
+    template = get_template(template_name)
+    key = hashlib.sha256()
+    key.update(("%s:%s:%s" % (payment.pk, template_name, os.path.getmtime(template.origin.name))).encode())
+    for stylesheet in stylesheets:
+        if os.path.isfile(stylesheet):
+            with open(stylesheet, "rb") as css:
+                key.update(css.read())
+        else:
+            key.update(stylesheet.encode())
+    return key.hexdigest()
+
+
+def get_invoice_path(payment, key):
+    return os.path.join(settings.INVOICE_CACHE_DIR, "%s-%s.pdf" % (payment.pk, key))
+
+
+def get_invoice_response(payment, template_name=INVOICE_TEMPLATE, stylesheets=()):
+    return WeasyTemplateResponse(request=None, template=template_name, context={"payment": payment},
+                                 stylesheets=list(stylesheets), content_type=CONTENT_TYPE_PDF)
+
+
+def render_invoice(payment, template_name=INVOICE_TEMPLATE, stylesheets=()):
+    """
+    Render the invoice of a payment, without request.
+
+    :return: The PDF as bytes
+    """
+    return get_invoice_response(payment, template_name, stylesheets).rendered_content
+
+
+def write_invoice(path, content):
+    """
+    Write an invoice in the cache, and remove the invoices of the same payment rendered with an older template.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")  # One per writer, threads included
+    with os.fdopen(fd, "wb") as pdf:
+        pdf.write(content)
+    os.replace(tmp, path)  # Atomic, a concurrent download never reads a partial file
+
+    payment_pk = os.path.basename(path).split("-", 1)[0]
+    for stale in glob.glob(os.path.join(os.path.dirname(path), "%s-*.pdf" % payment_pk)):
+        if stale != path:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:  # Already removed by another writer
+                pass
+
+
+def get_cached_invoice(payment, template_name=INVOICE_TEMPLATE, stylesheets=(), key=None):
+    """
+    Path of the invoice of a payment in the cache, rendered first if needed.
+
+    :param key: The key given by get_invoice_key(), computed if None
+    :return: The path of the PDF
+    """
+    key = key or get_invoice_key(payment, template_name, stylesheets)
+    path = get_invoice_path(payment, key)
+    if not os.path.exists(path):
+        write_invoice(path, render_invoice(payment, template_name, stylesheets))
+    return path
+
+
+# Pool of processes rendering the invoices in background, created on first use
+_pool = None
+
+
+def _init_worker():
+    django.setup()  # The processes are spawned, not forked: they don't share the db connections of the parent
+    set_backend(InlineBackend())  # Already out of the web workers, and a pool process can't have children
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.get_context("spawn").Pool(settings.INVOICE_WORKERS, initializer=_init_worker)
+    return _pool
+
+
+def close_pool():
+    """
+    Wait for the invoices being rendered in background. To call before a short-lived process ends.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+def prerender_invoice(payment_pk):
+    """
+    Render the invoice of a payment in the cache. Run in the pool of processes.
+
+    :param payment_pk: The primary key of the PaymentsUser
+    :return: The path of the PDF
+    """
+    from .models import PaymentsUser  # The apps are loaded by _init_worker
+
+    payment = PaymentsUser.objects.select_related("user", "product", "subscription").only(*INVOICE_FIELDS) \
+                                  .get(pk=payment_pk)
+    return get_cached_invoice(payment)
+
+
+def schedule_invoice(payment):
+    """
+    Render the invoice of a paid payment in background, once the current transaction is committed.
+    Nothing is done if settings.INVOICE_WORKERS is 0: the invoice is rendered on its first download.
+    """
+    if settings.INVOICE_WORKERS:
+        transaction.on_commit(lambda: get_pool().apply_async(prerender_invoice, (payment.pk,)))
+
+
+def get_export_queryset(user=None, start=None, end=None):
+    """
+    The paid payments to export, from the oldest.
+
+    :param user: Only the payments of this user (or primary key), all the users if None
+    :param start: Only the payments since this date
+    :param end: Only the payments until this date
+    """
+    from .models import PaymentsUser
+
+    payments = PaymentsUser.objects.filter(status="is_paid").select_related("user", "product", "subscription")
+    if user is not None:
+        payments = payments.filter(user=user)
+    if start is not None:
+        payments = payments.filter(date__gte=start)
+    if end is not None:
+        payments = payments.filter(date__lte=end)
+    return payments.order_by("date", "id")
+
+
+def iter_invoices(payments):
+    """
+    Path of the cached invoice of each payment, rendered in the pool of processes if settings.INVOICE_WORKERS.
+
+    :return: A generator of (payment, path), in the order of the payments
+    """
+    payments = list(payments)
+    if settings.INVOICE_WORKERS:
+        paths = get_pool().imap(prerender_invoice, [payment.pk for payment in payments])
+    else:
+        paths = (get_cached_invoice(payment) for payment in payments)
+    return zip(payments, paths)
+
+
+class _ZipStream(object):
+    """
+    Write-only file collecting what a ZipFile writes, so it can be streamed. ZipFile doesn't need to seek in it.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_invoices_zip(payments):
+    """
+    ZIP of the invoices of the payments, generated on the fly: only one invoice is in memory at a time.
+
+    :return: A generator of bytes
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED) as archive:  # A PDF is already compressed
+        for payment, path in iter_invoices(payments):
+            archive.write(path, "facture-%s.pdf" % payment.reference)
+            yield stream.pop()
+    yield stream.pop()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.utils.dateparse import parse_date
+
+from account.invoices import get_export_queryset, stream_invoices_zip, close_pool
+
+
+def date(value):
+    try:
+        parsed = parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = "Export the invoices of the paid payments in one ZIP"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Path of the file to write")
+        parser.add_argument("--user", type=int, help="Only the invoices of this user (primary key)")
+        parser.add_argument("--start", type=date, help="Only the invoices since this date (YYYY-MM-DD)")
+        parser.add_argument("--end", type=date, help="Only the invoices until this date (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        payments = get_export_queryset(user=options["user"], start=options["start"], end=options["end"])
+        with open(options["output"], "wb") as output:
+            for chunk in stream_invoices_zip(payments):
+                output.write(chunk)
+        close_pool()
+        self.stdout.write("%d invoices exported in %s" % (payments.count(), options["output"]))
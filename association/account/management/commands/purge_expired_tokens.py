@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from account.models import ValidateUser, ResetUserPassword
+
+
+class Command(BaseCommand):
+    help = "Delete the expired tokens of the email validations and the password resets"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Tokens deleted per query")
+
+    def handle(self, *args, **options):
+        for model in (ValidateUser, ResetUserPassword):
+            deleted = model.purge_expired(batch_size=options["batch_size"])
+            self.stdout.write("%s: %d expired tokens deleted" % (model.__name__, deleted))
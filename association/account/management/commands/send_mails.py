@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from account.email import send_queued_mails, mail_queue_stats
+
+
+class Command(BaseCommand):
+    help = "Send the emails queued by account.email"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="Emails sent per connection")
+        parser.add_argument("--forever", action="store_true", help="Keep waiting for new emails")
+        parser.add_argument("--sleep", type=float, default=5, help="Seconds between two polls with --forever")
+        parser.add_argument("--backend", help="Email backend to use instead of settings.EMAIL_BACKEND")
+        parser.add_argument("--stats", action="store_true", help="Only display the depth and the lag of the queue")
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            self.write_stats()
+            return
+
+        while True:
+            while send_queued_mails(batch_size=options["batch_size"], backend=options["backend"]) \
+                    == options["batch_size"]:
+                self.write_stats()
+            self.write_stats()
+            if not options["forever"]:
+                break
+            time.sleep(options["sleep"])
+
+    def write_stats(self):
+        stats = mail_queue_stats()
+        self.stdout.write("depth=%(depth)d lag=%(lag).1fs" % stats)
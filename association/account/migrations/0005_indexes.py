@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2017-11-06 14:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+PAID_INDEX = "account_pay_paid_until_idx"
+
+
+def create_paid_index(apps, schema_editor):
+    """
+    Partial index of the paid payments by end of subscription, for checks() and the renewals.
+    Only the databases supporting partial indexes get it.
+    """
+    if schema_editor.connection.vendor in ("sqlite", "postgresql"):
+        schema_editor.execute("CREATE INDEX %s ON account_paymentsuser (subscribed_until, user_id) "
+                              "WHERE status = 'is_paid'" % PAID_INDEX)
+
+
+def merge_duplicate_cards(apps, schema_editor):
+    """
+    A card could be stored several times before card_id was unique. The copies of a user's card are merged into
+    the last one, still available if one of them was. A card stored for several users can't be merged safely:
+    the migration stops, to fix them by hand first.
+    """
+    SaveCardUser = apps.get_model("account", "SaveCardUser")
+    duplicates = SaveCardUser.objects.values("card_id").annotate(count=models.Count("id")).filter(count__gt=1) \
+                                     .values_list("card_id", flat=True)
+    shared = []
+    for card_id in duplicates:
+        cards = list(SaveCardUser.objects.filter(card_id=card_id).order_by("-id"))
+        if len({card.user_id for card in cards}) > 1:
+            shared.append(card_id)
+            continue
+        last = cards[0]
+        if not last.card_available and any(card.card_available for card in cards):
+            SaveCardUser.objects.filter(pk=last.pk).update(card_available=True)
+        SaveCardUser.objects.filter(pk__in=[card.pk for card in cards[1:]]).delete()
+    if shared:
+        raise RuntimeError("Cards stored for several users, to fix before making card_id unique: %s"
+                           % ", ".join(sorted(shared)))
+
+
+def drop_paid_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ("sqlite", "postgresql"):
+        schema_editor.execute("DROP INDEX %s" % PAID_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0004_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cards, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='savecarduser',
+            name='card_id',
+            field=models.CharField(editable=False, max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='paymentsuser',
+            index=models.Index(fields=['user', 'status', 'subscribed_until'], name='account_pay_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='savecarduser',
+            index=models.Index(fields=['user', 'card_available', 'card_exp_date'], name='account_card_user_valid_idx'),
+        ),
+        migrations.RunPython(create_paid_index, drop_paid_index),
+    ]
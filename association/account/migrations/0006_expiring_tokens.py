@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2017-11-08 10:31
+from __future__ import unicode_literals
+
+import datetime
+import uuid
+
+from django.conf import settings
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def set_expiry(apps, schema_editor):
+    """
+    The links already sent stay valid for a full lifetime.
+    """
+    now = django.utils.timezone.now()
+    for model_name, setting in (("ValidateUser", "VALIDATE_TOKEN_LIFETIME"),
+                                ("ResetUserPassword", "RESET_PASSWORD_TOKEN_LIFETIME")):
+        expires = now + datetime.timedelta(seconds=getattr(settings, setting))
+        apps.get_model("account", model_name).objects.update(expires=expires)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0005_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resetuserpassword',
+            name='expires',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='validateuser',
+            name='expires',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_expiry, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='resetuserpassword',
+            name='token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='validateuser',
+            name='token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
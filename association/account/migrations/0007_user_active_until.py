@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2017-11-09 14:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_active_until(apps, schema_editor):
+    """
+    Fill the new columns from the last paid payment of each user.
+    """
+    User = apps.get_model("account", "User")
+    PaymentsUser = apps.get_model("account", "PaymentsUser")
+    done = set()
+    payments = PaymentsUser.objects.filter(status="is_paid").order_by("user_id", "-id") \
+                                   .values_list("user_id", "subscribed_until", "product_id")
+    for user_id, subscribed_until, product_id in payments.iterator():
+        if user_id not in done:
+            done.add(user_id)
+            User.objects.filter(pk=user_id).update(active_until=subscribed_until, current_product=product_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0003_product_unique_name'),
+        ('account', '0006_expiring_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='active_until',
+            field=models.DateField(blank=True, db_index=True, null=True, verbose_name='Subscribed until'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='current_product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='payment.Product'),
+        ),
+        migrations.RunPython(set_active_until, migrations.RunPython.noop),
+    ]
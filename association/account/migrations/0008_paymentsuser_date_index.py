@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2017-11-14 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0007_user_active_until'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='paymentsuser',
+            index=models.Index(fields=['user', 'date', 'id'], name='account_pay_user_date_idx'),
+        ),
+    ]
@@ -1,11 +1,48 @@
 import uuid
 import datetime
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 
 from payment.models import Subscription, Product
 
 
+class SubscriptionState(object):
+    """
+    Snapshot of the user's current subscription, built from the last validate payment.
+    The payment is loaded once, with its product and subscription, and shared by every accessor.
+    """
+
+    def __init__(self, payment=None):
+        self.payment = payment
+
+    @property
+    def subscription(self):
+        if self.payment is not None:
+            return self.payment.subscription
+        return None
+
+    @property
+    def product(self):
+        if self.payment is not None:
+            return self.payment.product
+        return None
+
+    @property
+    def recurrent(self):
+        if self.payment is not None:
+            return self.payment.product.recurrent
+        return None
+
+    @property
+    def subscribed_until(self):
+        if self.payment is not None:
+            return self.payment.subscribed_until
+        return None
+
+
 class User(AbstractUser):
     username = models.CharField(max_length=255, unique=True, verbose_name="Username")
     address = models.CharField(max_length=255, null=True)
@@ -16,10 +53,35 @@ class User(AbstractUser):
     country = models.CharField(max_length=255, null=True)
     email = models.EmailField(unique=True, verbose_name="Email Address")
     accreditation = models.IntegerField(default=0, verbose_name="Accreditation")  # To manage rights on the site
+    # End of the subscription and its product, from the last paid payment. Written with the payments
+    active_until = models.DateField(null=True, blank=True, db_index=True, verbose_name="Subscribed until")
+    current_product = models.ForeignKey(Product, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
 
     # payments = PaymentsUser(models.Model)
     # card = SaveCardUser(models.Model)
 
+    @property
+    def effective_accreditation(self):
+        """
+        The accreditation, lowered to 1 as soon as the subscription ended, without waiting for checks().
+        Read from the user's row only: no query.
+        """
+        if self.accreditation >= 2 and self.active_until is not None and self.active_until < datetime.date.today():
+            return 1
+        return self.accreditation
+
+    def extend_membership(self, payment):
+        """
+        Record the subscription paid by a payment. To call in the transaction saving the payment.
+
+        :param payment: The paid PaymentsUser
+        """
+        if self.active_until is None or payment.subscribed_until > self.active_until:
+            self.active_until = payment.subscribed_until
+        self.current_product_id = payment.product_id
+        self.invalidate_subscription_state()
+        self.save(update_fields=["active_until", "current_product"])
+
     def test_any_payment_valide(self):  # has_valid_payment
         return self.payments.filter(status='is_paid').exists()
 
@@ -35,12 +97,31 @@ class User(AbstractUser):
     def get_all_payments(self):
         return self.payments.all()
 
-    def get_last_validate_payment(self):
+    @property
+    def subscription_state(self):
+        """
+        Memoized on the instance, so request.user only hits the db once per request.
+        """
         try:
-            return self.payments.filter(status="is_paid", subscribed_until__gte=datetime.date.today()) \
-                                .order_by("-id")[0]
-        except IndexError:
-            return None
+            return self._subscription_state
+        except AttributeError:
+            try:
+                payment = self.payments.filter(status="is_paid", subscribed_until__gte=datetime.date.today()) \
+                                       .select_related("product", "subscription").order_by("-id")[0]
+            except IndexError:
+                payment = None
+            self._subscription_state = SubscriptionState(payment)
+            return self._subscription_state
+
+    def invalidate_subscription_state(self):
+        self.__dict__.pop("_subscription_state", None)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.invalidate_subscription_state()
+        super(User, self).refresh_from_db(*args, **kwargs)
+
+    def get_last_validate_payment(self):
+        return self.subscription_state.payment
 
     def get_last_validate_card(self):
         try:
@@ -50,48 +131,110 @@ class User(AbstractUser):
             return None
 
     def get_subscription(self):
-        payment = self.get_last_validate_payment()
-        if payment is not None:
-            return payment.subscription
-        return None
+        return self.subscription_state.subscription
 
     def get_product(self):
-        payment = self.get_last_validate_payment()
-        if payment is not None:
-            return payment.product
-        return None
+        return self.subscription_state.product
 
     def get_recurrent(self):
-        product = self.get_product()
-        if product is not None:
-            return product.recurrent
-        return None
+        return self.subscription_state.recurrent
 
-    def set_accreditation(self, lvl):
+    def set_accreditation(self, lvl, update_fields=None):
+        """
+        :param update_fields: Columns written, by default the whole user with the other changes of the caller
+        """
+        self.invalidate_subscription_state()
         if self.accreditation != lvl:
             self.accreditation = lvl
-            self.save()
+            self.save(update_fields=update_fields)
 
     def unsuscribe(self):  # unsubscribe
         self.set_accreditation(1)
         payment = self.get_last_validate_payment()
         payment.status = "unsuscribe"
         payment.save()
+        self.invalidate_subscription_state()
         card = self.get_last_validate_card()
         if card is not None:
             card.card_available = False
             card.save()
 
 
-class ValidateUser(models.Model):  # ValidUser
-    token = models.UUIDField(default=uuid.uuid4, editable=False)
+class TokenQuerySet(models.QuerySet):
+    def valid(self):
+        return self.filter(expires__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires__lte=timezone.now())
+
+
+class ExpiringToken(models.Model):
+    """
+    Token of a link sent by email. It's deleted once used, and can't be used after its expiry.
+    """
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    expires = models.DateTimeField(db_index=True, editable=False)
+
+    objects = TokenQuerySet.as_manager()
+    lifetime_setting = None  # Name of the setting giving the lifetime of the tokens, in seconds
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self.expires is None:
+            self.expires = timezone.now() + datetime.timedelta(seconds=getattr(settings, self.lifetime_setting))
+        super(ExpiringToken, self).save(*args, **kwargs)
+
+    @classmethod
+    def get_user(cls, token):
+        """
+        :return: The user of the token, None if the token doesn't exist or expired
+        """
+        try:
+            return cls.objects.valid().select_related("user").get(token=token).user
+        except (cls.DoesNotExist, ValidationError):
+            return None
+
+    @classmethod
+    def consume(cls, token):
+        """
+        Use a token: it's deleted, with the other tokens of the same kind of its user.
+
+        :return: The user of the token, None if the token doesn't exist or expired
+        """
+        user = cls.get_user(token)
+        if user is not None:
+            cls.objects.filter(user=user).delete()
+        return user
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000):
+        """
+        Delete the expired tokens, batch_size at once so the table isn't locked for long.
+
+        :return: The number of deleted tokens
+        """
+        deleted = 0
+        while True:
+            pks = list(cls.objects.expired().values_list("pk", flat=True)[:batch_size])
+            if pks:
+                deleted += cls.objects.filter(pk__in=pks).delete()[0]
+            if len(pks) < batch_size:
+                return deleted
+
+
+class ValidateUser(ExpiringToken):  # ValidUser
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    lifetime_setting = "VALIDATE_TOKEN_LIFETIME"
 
-class ResetUserPassword(models.Model):  # UserPasswordReset
-    token = models.UUIDField(default=uuid.uuid4, editable=False)
+
+class ResetUserPassword(ExpiringToken):  # UserPasswordReset
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    lifetime_setting = "RESET_PASSWORD_TOKEN_LIFETIME"
+
 
 class PaymentsUser(models.Model):  # Payment
     reference = models.CharField(max_length=255, unique=True, editable=False)  # Payment id generated by Payplug
@@ -109,16 +252,58 @@ class PaymentsUser(models.Model):  # Payment
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="payments")
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="payments")
 
+    class Meta:
+        indexes = [
+            # get_last_validate_payment(), test_any_payment_valide(). The partial index of the paid payments
+            # by date, for checks() and the renewals, is created by the migration 0005.
+            models.Index(fields=["user", "status", "subscribed_until"], name="account_pay_user_status_idx"),
+            models.Index(fields=["user", "date", "id"], name="account_pay_user_date_idx"),  # DisplayPayments
+        ]
+
     @property
     def ht_cost(self):
         return int(self.price / (1 + self.tva / 100))
 
+    def save(self, *args, **kwargs):
+        super(PaymentsUser, self).save(*args, **kwargs)
+        if PaymentsUser.user.is_cached(self):  # Keep the user's subscription snapshot up to date
+            self.user.invalidate_subscription_state()
+
 
 class SaveCardUser(models.Model):  # Card
     date = models.DateTimeField(auto_now=True)
     first_name = models.CharField(max_length=255, editable=False)
     last_name = models.CharField(max_length=255, editable=False)
-    card_id = models.CharField(max_length=255, editable=False)
+    card_id = models.CharField(max_length=255, unique=True, editable=False)
     card_exp_date = models.DateField(editable=False)
     card_available = models.BooleanField(default=True, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="card")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "card_available", "card_exp_date"], name="account_card_user_valid_idx"),
+        ]
+
+
+class OutgoingEmail(models.Model):
+    """
+    Email queued by account.email, until the send_mails command sends it.
+    An email being sent is claimed by its worker until next_attempt, then it is taken again if still not sent.
+    """
+    PENDING = ""
+    SENDING = "sending"
+    SENT = "sent"
+    ERROR = "error"
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    to = models.TextField()  # Addresses separated by commas
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, db_index=True)
+    status = models.CharField(max_length=255, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)  # Not sent before
+    error_message = models.CharField(max_length=255, default="")
+
+    def __str__(self):
+        return "%s %s" % (self.to, self.status)
@@ -1,14 +1,40 @@
 import datetime
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import zipfile
 from collections import namedtuple
+from importlib import import_module
+from io import BytesIO, StringIO
+from unittest import skipUnless
+from unittest.mock import patch, PropertyMock
 
+from django.core import mail
 from django.core.exceptions import PermissionDenied
-from django.test import TestCase
+from django.core.management import call_command
+from django.template import engines
+from django.template.loader import get_template
+from django.template.loaders.cached import Loader as CachedLoader
+from django.template.loaders.filesystem import Loader as FilesystemLoader
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.urls.exceptions import NoReverseMatch
+from django.utils import timezone, translation
+from django_weasyprint import WeasyTemplateResponse
 
-from account.models import User, ValidateUser, ResetUserPassword, PaymentsUser, SaveCardUser
+from account.models import User, ValidateUser, ResetUserPassword, PaymentsUser, SaveCardUser, OutgoingEmail
+from association import settings_production
+from association.warmup import warm_up_templates
 from payment.models import Subscription, Product
+from .email import send_queued_mails, mail_queue_stats, send_mass_mail_template
 from .api import AnonymousRequiredMixin, AccreditationViewRequiredMixin, accreditation_view_required
+from .invoices import INVOICE_FIELDS, prerender_invoice, schedule_invoice, stream_invoices_zip, get_export_queryset, \
+    write_invoice
 
 Login = reverse(u"login")
 Dashboard = reverse(u"dashboard")
@@ -20,6 +46,7 @@ Forgot = reverse(u"forgot")
 Change = reverse(u"change_password")
 Payments = reverse(u"display_payments")
 Unsubscribe = reverse(u"unsubscribe")
+Export = reverse(u"export")
 
 
 class FakeResponse:
@@ -79,7 +106,10 @@ def fake_view(request, perm=1, strict=False, redirect_url=None, raise_exception=
     return fake_view_response(request)
 
 
-_User = namedtuple("User", ("is_authenticated", "accreditation"))
+class _User(namedtuple("User", ("is_authenticated", "accreditation"))):
+    @property
+    def effective_accreditation(self):
+        return self.accreditation
 
 
 class TestAnonymousMixin(TestCase):
@@ -242,6 +272,31 @@ class TestAccreditationViewRequiredDecorator(TestCase):
         self.assertEqual(response.status_code, 302)
 
 
+class TestEffectiveAccreditation(TestCase):
+    def setUp(self):
+        yesterday = datetime.date.today() - datetime.timedelta(1)
+        self.expired = User(username="guillaume", accreditation=2, active_until=yesterday)
+
+    def test_effective_accreditation(self):
+        self.assertEqual(self.expired.effective_accreditation, 1)
+        self.assertEqual(User(accreditation=2).effective_accreditation, 2)
+        self.assertEqual(User(accreditation=2, active_until=datetime.date.today()).effective_accreditation, 2)
+        self.assertEqual(User(accreditation=0, active_until=datetime.date(2000, 1, 1)).effective_accreditation, 0)
+
+    def test_mixin(self):
+        view = FakeAccreditationViewRequiredView()
+        view.accreditation = 2
+        with self.assertNumQueries(0):
+            response = view.dispatch(Request(user=self.expired))
+        self.assertEqual(response.status_code, 302)
+
+    def test_decorator(self):
+        with self.assertNumQueries(0):
+            response = fake_view(Request(user=self.expired), perm=2)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(fake_view(Request(user=self.expired), perm=1).status_code, 200)
+
+
 class TestCustomLoginView(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -367,6 +422,15 @@ class TestResendEmailView(TestCase):
         response = self.client.post(Resend, data={"email": self.user.email})
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.url, Dashboard)
+        self.assertEqual(OutgoingEmail.objects.get().to, self.user.email)
+        self.assertEqual(mail.outbox, [])  # Sent later by the send_mails command
+
+    def test_post_expired(self):
+        ValidateUser.objects.update(expires=timezone.now())
+        self.client.post(Resend, data={"email": self.user.email})
+
+        token = ValidateUser.objects.valid().get(user=self.user).token
+        self.assertIn(str(token), OutgoingEmail.objects.get().body)
 
     def test_post_invalid(self):
         response = self.client.post(Resend, data={"email": "c@t.com"})
@@ -389,6 +453,8 @@ class TestForgotPasswordView(TestCase):
         response = self.client.post(Forgot, data={"username": "guillaume", "email": "te@test.com", })
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.url, Login)
+        self.assertEqual(OutgoingEmail.objects.get().to, "te@test.com")
+        self.assertEqual(mail.outbox, [])
 
     def test_post_invalid(self):
         response = self.client.post(Forgot, data={"username": "guil", "email": "te@tet.com", })
@@ -435,6 +501,20 @@ class TestResetPasswordView(TestCase):
         response = self.client.post(self.path, data={"new_password1": "testt", "new_password2": "testt"})
         self.assertEqual(response.status_code, 200)
 
+    def test_consumed(self):
+        other = ResetUserPassword.objects.create(user=self.user)
+        self.client.post(self.path, data={"new_password1": "mdpaupif", "new_password2": "mdpaupif"})
+
+        self.assertFalse(ResetUserPassword.objects.exists())  # The other links of the user are useless
+        self.assertEqual(self.client.get(self.path).url, Dashboard)
+        self.assertEqual(self.client.get(reverse(u"reset_password", kwargs={"token": other.token})).url, Dashboard)
+
+    def test_expired(self):
+        ResetUserPassword.objects.update(expires=timezone.now())
+        response = self.client.get(self.path)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, Dashboard)
+
 
 class TestChangePasswordView(TestCase):
     @classmethod
@@ -492,6 +572,85 @@ class TestDisplayPayments(TestCase):
         self.assertEqual(response.status_code, 405)
 
 
+class TestDisplayPaymentsPages(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User(username="guillaume", email="te@test.com", accreditation=2, address="rue")
+        cls.user.set_password('passpass')
+        cls.user.save()
+        other = User.objects.create(username="other", email="other@test.com")
+        subscription = Subscription.objects.create(name="gold", description="test")
+        product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                         recurrent=True, duration=50, subscription=subscription)
+        for i in range(25):  # 5 payments a day, the 5 latest the same day
+            payment = PaymentsUser.objects.create(reference="pay_%d" % i, price=120, tva=20, product=product,
+                                                  subscription=subscription, user=cls.user)
+            PaymentsUser.objects.filter(pk=payment.pk).update(date=datetime.date(2017, 1, 1 + i // 5))
+        PaymentsUser.objects.create(reference="pay_other", price=120, tva=20, product=product,
+                                    subscription=subscription, user=other)
+
+    def setUp(self):
+        self.client.login(username="guillaume", password="passpass")
+
+    def get_references(self, response):
+        return [payment.reference for payment in response.context["payments"]]
+
+    def test_pages(self):
+        references, cursor = [], None
+        while True:
+            response = self.client.get(Payments, {"after": cursor} if cursor else {})
+            references += self.get_references(response)
+            page = response.context["page_obj"]
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+
+        self.assertEqual(references, ["pay_%d" % i for i in reversed(range(25))])
+        self.assertIsNone(page.count)
+
+    def test_previous(self):
+        first = self.client.get(Payments)
+        second = self.client.get(Payments, {"after": first.context["page_obj"].next_cursor})
+        back = self.client.get(Payments, {"before": second.context["page_obj"].previous_cursor})
+
+        self.assertContains(first, "?after=%s" % first.context["page_obj"].next_cursor, count=1)
+        self.assertNotContains(first, "?before=")
+        self.assertTrue(second.context["page_obj"].has_previous())
+        self.assertEqual(self.get_references(back), self.get_references(first))
+        self.assertFalse(back.context["page_obj"].has_previous())
+        self.assertTrue(back.context["page_obj"].has_next())
+
+    def test_size(self):
+        self.assertEqual(len(self.get_references(self.client.get(Payments, {"size": 3}))), 3)
+        self.assertEqual(len(self.get_references(self.client.get(Payments, {"size": 1000}))), 25)
+        self.assertEqual(len(self.get_references(self.client.get(Payments, {"size": "a"}))), 10)
+
+    @override_settings(PAGE_COUNT=True)
+    def test_count(self):
+        response = self.client.get(Payments)
+        self.assertEqual(response.context["page_obj"].count, 25)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(Payments, {"after": "2017-01-01"}).status_code, 404)
+        self.assertEqual(self.client.get(Payments, {"after": "a_1"}).status_code, 404)
+
+    def test_flat_queries(self):
+        first = self.client.get(Payments)
+        cursor = self.client.get(Payments, {"after": first.context["page_obj"].next_cursor}) \
+                            .context["page_obj"].next_cursor
+        with CaptureQueriesContext(connection) as first_queries:
+            self.client.get(Payments)
+        with CaptureQueriesContext(connection) as last_queries:
+            response = self.client.get(Payments, {"after": cursor})
+
+        self.assertEqual(len(self.get_references(response)), 5)
+        self.assertEqual(len(first_queries), len(last_queries))
+        sql = " ".join(query["sql"] for query in last_queries)
+        self.assertNotIn("COUNT(", sql)
+        self.assertNotIn("OFFSET", sql)
+        self.assertIn('"payment_product"', sql)  # select_related, no query per payment
+
+
 class TestValidate(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -525,6 +684,21 @@ class TestValidate(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.url, Login)
 
+    def test_consumed(self):
+        self.client.get(self.path)
+        self.assertFalse(ValidateUser.objects.exists())
+
+        response = self.client.get(self.path)
+        self.assertEqual(response.url, Dashboard)
+
+    def test_expired(self):
+        ValidateUser.objects.update(expires=timezone.now())
+        response = self.client.get(self.path)
+
+        self.user.refresh_from_db()
+        self.assertEqual(response.url, Dashboard)
+        self.assertEqual(self.user.accreditation, 0)
+
 
 class TestUnsubscribe(TestCase):
     @classmethod
@@ -697,7 +871,7 @@ class TestGetLastValidateCard(TestCase):
 
         SaveCardUser.objects.create(first_name="g", last_name="t", card_id="g", card_exp_date=date, card_available=True,
                                     user=self.user)
-        card = SaveCardUser.objects.create(first_name="g", last_name="t", card_id="g", card_exp_date=date,
+        card = SaveCardUser.objects.create(first_name="g", last_name="t", card_id="h", card_exp_date=date,
                                            card_available=True, user=self.user)
 
         check = self.user.get_last_validate_card()
@@ -728,3 +902,634 @@ class TestHtCost(TestCase):
                                               user=self.user)
 
         self.assertEqual(payment.ht_cost, 100)
+
+
+class TestSubscriptionState(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User(username="guillaume", email="te@test.com", accreditation=2)
+        cls.user.set_password('passpass')
+        cls.user.save()
+
+        date = datetime.date.today()
+        end = date + datetime.timedelta(10)
+
+        cls.subscription = Subscription.objects.create(name="gold", description="test")
+        cls.product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                             recurrent=True, duration=50, subscription=cls.subscription)
+        cls.payment = PaymentsUser.objects.create(reference="a", date=date, subscribed_until=end, status="is_paid",
+                                                  price=120, tva=20, subscription=cls.subscription,
+                                                  product=cls.product, user=cls.user)
+
+    def setUp(self):
+        self.user = User.objects.get(pk=self.user.pk)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.get_last_validate_payment(), self.payment)
+            self.assertEqual(self.user.get_subscription(), self.subscription)
+            self.assertEqual(self.user.get_product(), self.product)
+            self.assertIs(self.user.get_recurrent(), True)
+
+    def test_invalidate_on_accreditation(self):
+        self.user.get_last_validate_payment()
+        self.payment.status = "unsuscribe"
+        self.payment.save()
+
+        self.user.set_accreditation(1)
+        self.assertEqual(self.user.get_last_validate_payment(), None)
+
+    def test_accreditation_keeps_changes(self):
+        self.user.city = "Paris"
+        self.user.set_accreditation(1)
+        self.user.refresh_from_db()
+
+        self.assertEqual((self.user.accreditation, self.user.city), (1, "Paris"))
+
+    def test_invalidate_on_new_payment(self):
+        self.user.get_last_validate_payment()
+        end = datetime.date.today() + datetime.timedelta(20)
+        payment = PaymentsUser.objects.create(reference="b", subscribed_until=end, status="is_paid", price=120,
+                                              tva=20, subscription=self.subscription, product=self.product,
+                                              user=self.user)
+
+        self.assertEqual(self.user.get_last_validate_payment(), payment)
+
+    def test_unsuscribe(self):
+        self.user.unsuscribe()
+        self.assertEqual(self.user.get_last_validate_payment(), None)
+        self.assertEqual(self.user.get_subscription(), None)
+
+
+class TestUserAdminChangelist(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User(username="admin", email="admin@test.com", accreditation=1, is_staff=True,
+                         is_superuser=True)
+        cls.admin.set_password('passpass')
+        cls.admin.save()
+
+        cls.subscription = Subscription.objects.create(name="gold", description="test")
+        cls.product = Product.objects.create(name="silver", description="rien", price=120, tva=20, ht=100,
+                                             recurrent=True, duration=50, subscription=cls.subscription)
+        cls.path = reverse(u"admin:account_user_changelist")
+
+    def setUp(self):
+        self.client.login(username="admin", password="passpass")
+
+    def create_member(self, name):
+        user = User.objects.create(username=name, email="%s@test.com" % name, accreditation=2)
+        end = datetime.date.today() + datetime.timedelta(10)
+        PaymentsUser.objects.create(reference=name, subscribed_until=end, status="is_paid", price=120, tva=20,
+                                    subscription=self.subscription, product=self.product, user=user)
+        return user
+
+    def test_columns(self):
+        self.create_member("a")
+        response = self.client.get(self.path)
+        self.assertContains(response, "silver")
+        self.assertContains(response, "gold")
+
+    def test_queries_do_not_grow_with_users(self):
+        self.create_member("a")
+        with CaptureQueriesContext(connection) as one:
+            self.client.get(self.path)
+        for name in ("b", "c", "d"):
+            self.create_member(name)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(self.path)
+        self.assertEqual(len(one), len(many))
+
+    def test_sortable(self):
+        self.create_member("a")
+        response = self.client.get(self.path, {"o": "3"})
+        self.assertEqual(response.status_code, 200)
+
+
+class TestDownloadPayment(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User(username="guillaume", email="te@test.com", accreditation=2)
+        cls.user.set_password('passpass')
+        cls.user.save()
+
+        subscription = Subscription.objects.create(name="gold", description="test")
+        product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                         recurrent=True, duration=50, subscription=subscription)
+        cls.payment = PaymentsUser.objects.create(reference="a", subscribed_until=datetime.date.today(),
+                                                  status="is_paid", price=120, tva=20, subscription=subscription,
+                                                  product=product, user=cls.user)
+        cls.path = reverse(u"download", kwargs={"pk": cls.payment.pk})
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_settings = override_settings(INVOICE_CACHE_DIR=self.cache_dir)
+        self.cache_settings.enable()
+        self.client.login(username="guillaume", password="passpass")
+
+    def tearDown(self):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_dir)
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_rendered_once(self, render_mock):
+        response = self.client.get(self.path)
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF-a")
+        response.close()
+        response = self.client.get(self.path)
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF-a")
+        response.close()
+
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertEqual(render_mock.call_count, 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_concurrent_writes(self):
+        path = os.path.join(self.cache_dir, "1-key.pdf")
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def write():
+            barrier.wait()
+            try:
+                for _ in range(20):
+                    write_invoice(path, b"%PDF-a")
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.cache_dir), ["1-key.pdf"])
+
+    def test_stale_already_removed(self):
+        path = os.path.join(self.cache_dir, "1-new.pdf")
+        with patch("account.invoices.glob.glob", return_value=[os.path.join(self.cache_dir, "1-old.pdf"), path]):
+            write_invoice(path, b"%PDF-a")
+        self.assertEqual(os.listdir(self.cache_dir), ["1-new.pdf"])
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_not_modified(self, render_mock):
+        etag = self.client.get(self.path)["ETag"]
+        response = self.client.get(self.path, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_template_changed(self, render_mock):
+        response = self.client.get(self.path)
+        response.close()
+        with patch("account.invoices.os.path.getmtime", return_value=0):
+            changed = self.client.get(self.path)
+            changed.close()
+
+        self.assertNotEqual(response["ETag"], changed["ETag"])
+        self.assertEqual(render_mock.call_count, 2)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_unpaid_not_cached(self, render_mock):
+        self.payment.status = "aborted"
+        self.payment.save()
+        response = self.client.get(self.path)
+
+        self.assertEqual(response.content, b"%PDF-a")
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_prerendered(self, render_mock):
+        path = prerender_invoice(self.payment.pk)
+        response = self.client.get(self.path)
+        response.close()
+
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(path)])
+        self.assertEqual(render_mock.call_count, 1)
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_other_user(self, render_mock):
+        other = User.objects.create(username="other", email="other@test.com")
+        payment = PaymentsUser.objects.create(reference="b", status="is_paid", price=120, tva=20, user=other,
+                                              subscription=self.payment.subscription, product=self.payment.product)
+
+        self.assertEqual(self.client.get(reverse(u"download", kwargs={"pk": payment.pk})).status_code, 404)
+        self.assertEqual(self.client.get(reverse(u"download", kwargs={"pk": "b"})).status_code, 404)
+        self.assertFalse(render_mock.called)
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_by_reference(self, render_mock):
+        response = self.client.get(reverse(u"download", kwargs={"pk": "a"}))
+        response.close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], self.client.get(self.path)["ETag"])
+
+    def test_not_a_number(self):
+        self.assertEqual(self.client.get(reverse(u"download", kwargs={"pk": "\u00b2"})).status_code, 404)
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_single_query(self, render_mock):
+        self.payment.status = "aborted"
+        self.payment.save()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.path)
+        payments = [query["sql"] for query in queries if '"account_paymentsuser"' in query["sql"]]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(payments), 1)
+        self.assertIn('"payment_product"."recurrent"', payments[0])
+        self.assertIn('"account_user"."city"', payments[0])
+        self.assertNotIn('"account_user"."password"', payments[0])
+        self.assertNotIn('"account_paymentsuser"."token"', payments[0])
+
+    def test_template_fields(self):
+        render = get_template("payment/facture.html").render
+        payment = PaymentsUser.objects.select_related("product", "subscription", "user").only(*INVOICE_FIELDS) \
+                                      .get(pk=self.payment.pk)
+        with self.assertNumQueries(0):
+            render({"payment": payment})
+
+    @patch("account.invoices.transaction.on_commit")
+    def test_schedule(self, on_commit_mock):
+        with self.settings(INVOICE_WORKERS=2):
+            schedule_invoice(self.payment)
+        with self.settings(INVOICE_WORKERS=0):
+            schedule_invoice(self.payment)
+
+        self.assertEqual(on_commit_mock.call_count, 1)
+
+
+@override_settings(INVOICE_WORKERS=0)
+class TestExportPayments(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User(username="guillaume", email="te@test.com", accreditation=2)
+        cls.user.set_password('passpass')
+        cls.user.save()
+        cls.other = User.objects.create(username="other", email="other@test.com", accreditation=2)
+        cls.staff = User(username="staff", email="staff@test.com", accreditation=2, is_staff=True)
+        cls.staff.set_password('passpass')
+        cls.staff.save()
+
+        subscription = Subscription.objects.create(name="gold", description="test")
+        product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                         recurrent=True, duration=50, subscription=subscription)
+        for reference, user, status, date in (("a", cls.user, "is_paid", datetime.date(2017, 1, 1)),
+                                              ("b", cls.user, "is_paid", datetime.date(2017, 6, 1)),
+                                              ("c", cls.user, "aborted", datetime.date(2017, 6, 1)),
+                                              ("d", cls.other, "is_paid", datetime.date(2017, 6, 1))):
+            payment = PaymentsUser.objects.create(reference=reference, subscribed_until=date, status=status,
+                                                  price=120, tva=20, subscription=subscription, product=product,
+                                                  user=user)
+            PaymentsUser.objects.filter(pk=payment.pk).update(date=date)  # date is auto_now_add
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_settings = override_settings(INVOICE_CACHE_DIR=self.cache_dir)
+        self.cache_settings.enable()
+
+    def tearDown(self):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_dir)
+
+    def get_names(self, content):
+        return zipfile.ZipFile(BytesIO(content)).namelist()
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_own_invoices(self, render_mock):
+        self.client.login(username="guillaume", password="passpass")
+        response = self.client.get(Export, {"user": self.other.pk})
+        content = b"".join(response.streaming_content)
+
+        self.assertEqual(response["Content-Type"], "application/zip")
+        self.assertEqual(self.get_names(content), ["facture-a.pdf", "facture-b.pdf"])
+        self.assertEqual(zipfile.ZipFile(BytesIO(content)).read("facture-a.pdf"), b"%PDF-a")
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_staff(self, render_mock):
+        self.client.login(username="staff", password="passpass")
+        response = self.client.get(Export, {"start": "2017-03-01"})
+        self.assertEqual(self.get_names(b"".join(response.streaming_content)), ["facture-b.pdf", "facture-d.pdf"])
+
+        response = self.client.get(Export, {"user": self.other.pk})
+        self.assertEqual(self.get_names(b"".join(response.streaming_content)), ["facture-d.pdf"])
+        self.assertEqual(render_mock.call_count, 2)  # d is in the cache
+
+    def test_bad_date(self):
+        self.client.login(username="staff", password="passpass")
+        response = self.client.get(Export, {"end": "2017-02-30"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_anonymous(self):
+        response = self.client.get(Export)
+        self.assertEqual(response.status_code, 302)
+
+    def test_bad_user(self):
+        self.client.login(username="staff", password="passpass")
+        response = self.client.get(Export, {"user": "abc"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_zip_only(self):
+        self.client.login(username="guillaume", password="passpass")
+        response = self.client.get(Export, {"format": "pdf"})
+        self.assertEqual(response.status_code, 400)
+
+    @patch("account.invoices.get_pool")
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_pool(self, render_mock, pool_mock):
+        pool_mock.return_value.imap.side_effect = map  # The pool processes don't see the test database
+        with self.settings(INVOICE_WORKERS=2):
+            content = b"".join(stream_invoices_zip(get_export_queryset(user=self.user)))
+
+        self.assertEqual(self.get_names(content), ["facture-a.pdf", "facture-b.pdf"])
+        pool_mock.return_value.imap.assert_called_once_with(prerender_invoice, [payment.pk for payment in
+                                                                                get_export_queryset(user=self.user)])
+
+    @patch.object(WeasyTemplateResponse, "rendered_content", new_callable=PropertyMock, return_value=b"%PDF-a")
+    def test_command(self, render_mock):
+        output = os.path.join(self.cache_dir, "export.zip")
+        stdout = StringIO()
+        call_command("export_invoices", output, "--end", "2017-03-01", stdout=stdout)
+
+        with open(output, "rb") as archive:
+            self.assertEqual(self.get_names(archive.read()), ["facture-a.pdf"])
+        self.assertEqual(stdout.getvalue(), "1 invoices exported in %s\n" % output)
+
+
+class TestMailQueue(TestCase):
+    def setUp(self):
+        for i in range(3):
+            OutgoingEmail.objects.create(subject="subject %d" % i, body="body", to="a%d@test.com,b@test.com" % i)
+
+    def test_send(self):
+        self.assertEqual(send_queued_mails(batch_size=2), 2)
+        self.assertEqual([message.to for message in mail.outbox],
+                         [["a0@test.com", "b@test.com"], ["a1@test.com", "b@test.com"]])
+        self.assertEqual(mail_queue_stats()["depth"], 1)
+
+        self.assertEqual(send_queued_mails(), 1)
+        self.assertEqual(send_queued_mails(), 0)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(OutgoingEmail.objects.filter(sent__isnull=True).exists())
+
+    def test_single_connection(self):
+        with patch("account.email.get_connection", wraps=mail.get_connection) as connection_mock:
+            send_queued_mails()
+        connection_mock.assert_called_once_with(None)
+        self.assertEqual(len(mail.outbox), 3)
+
+    @patch("account.email.EmailMessage.send", side_effect=OSError("Connection refused"))
+    def test_error(self, send_mock):
+        with self.settings(EMAIL_MAX_ATTEMPTS=2):
+            send_queued_mails()
+            self.assertEqual(mail_queue_stats()["depth"], 3)
+            OutgoingEmail.objects.update(next_attempt=timezone.now())  # The delay is over
+            send_queued_mails()
+
+        self.assertEqual(mail_queue_stats()["depth"], 0)
+        email = OutgoingEmail.objects.first()
+        self.assertEqual((email.status, email.attempts, email.error_message), (OutgoingEmail.ERROR, 2,
+                                                                               "Connection refused"))
+
+    @patch("account.email.EmailMessage.send", side_effect=OSError("Connection refused"))
+    def test_backoff(self, send_mock):
+        with self.settings(EMAIL_RETRY_DELAY=60):
+            self.assertEqual(send_queued_mails(), 3)
+            self.assertEqual(send_queued_mails(), 0)  # Not tried again right away
+            OutgoingEmail.objects.update(next_attempt=timezone.now())
+            before = timezone.now()
+            send_queued_mails()
+
+        self.assertEqual(send_mock.call_count, 6)
+        email = OutgoingEmail.objects.first()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.PENDING, 2))
+        self.assertGreaterEqual(email.next_attempt, before + datetime.timedelta(seconds=120))
+
+    def test_connection_error(self):
+        with patch("django.core.mail.backends.locmem.EmailBackend.open", side_effect=OSError("Server down")):
+            self.assertEqual(send_queued_mails(), 3)
+
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(list(OutgoingEmail.objects.values_list("status", "attempts", "error_message").distinct()),
+                         [(OutgoingEmail.PENDING, 1, "Server down")])
+
+    def test_claimed(self):
+        first = OutgoingEmail.objects.order_by("id").first()
+        OutgoingEmail.objects.filter(pk=first.pk).update(status=OutgoingEmail.SENDING,
+                                                         next_attempt=timezone.now() + datetime.timedelta(60))
+        self.assertEqual(send_queued_mails(), 2)  # The first one is being sent by another worker
+        self.assertEqual(mail_queue_stats()["depth"], 1)
+
+        OutgoingEmail.objects.filter(pk=first.pk).update(next_attempt=timezone.now())  # That worker died
+        self.assertEqual(send_queued_mails(), 1)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command("send_mails", "--backend", "django.core.mail.backends.dummy.EmailBackend", stdout=stdout)
+
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(OutgoingEmail.objects.filter(status=OutgoingEmail.SENT).count(), 3)
+        self.assertEqual(stdout.getvalue(), "depth=0 lag=0.0s\n")
+
+
+class TestMassMail(TestCase):
+    def setUp(self):
+        self.recipients = [("a%d@test.com" % i, "en" if i % 2 else None) for i in range(5)]
+
+    @patch("account.email.render_to_string", side_effect=lambda name, context: translation.get_language())
+    def test_send(self, render_mock):
+        report = send_mass_mail_template("Renewal", "account/register_mail.html", self.recipients, batch_size=2,
+                                         max_rate=0)
+
+        self.assertEqual(render_mock.call_count, 2)
+        self.assertEqual([(message.to, message.body) for message in mail.outbox],
+                         [(["a0@test.com"], "fr-fr"), (["a2@test.com"], "fr-fr"), (["a4@test.com"], "fr-fr"),
+                          (["a1@test.com"], "en"), (["a3@test.com"], "en")])
+        self.assertEqual((report.messages, report.sent, report.errors), (5, 5, []))
+
+    def test_single_connection(self):
+        connection = mail.get_connection()
+        with patch.object(connection, "open") as open_mock, \
+                patch.object(connection, "send_messages", wraps=connection.send_messages) as send_mock:
+            send_mass_mail_template("Renewal", "account/register_mail.html", self.recipients, batch_size=2,
+                                    max_rate=0, connection=connection)
+
+        self.assertEqual(open_mock.call_count, 1)
+        self.assertEqual([len(call[0][0]) for call in send_mock.call_args_list], [2, 2, 1])
+
+    @patch("account.email.time.sleep")
+    def test_throttle(self, sleep_mock):
+        report = send_mass_mail_template("Renewal", "account/register_mail.html", self.recipients, batch_size=2,
+                                         max_rate=1)
+
+        self.assertEqual(sleep_mock.call_count, 3)
+        self.assertAlmostEqual(sleep_mock.call_args_list[-1][0][0], 5, delta=1)
+        self.assertEqual(report.sent, 5)
+
+    def test_error(self):
+        connection = mail.get_connection()
+        with patch.object(connection, "send_messages",
+                          side_effect=[OSError("Connection lost"), 2, 1]) as send_mock:
+            report = send_mass_mail_template("Renewal", "account/register_mail.html", self.recipients, batch_size=2,
+                                             max_rate=0, connection=connection)
+
+        self.assertEqual(send_mock.call_count, 3)
+        self.assertEqual(report.sent, 3)
+        self.assertEqual(report.errors[0][0], ["a0@test.com", "a2@test.com"])
+        self.assertIn("rate=", repr(report))
+
+
+@override_settings(TEMPLATES=settings_production.TEMPLATES)
+class TestWarmUpTemplates(TestCase):
+    def test_production_settings(self):
+        self.assertFalse(settings_production.DEBUG)
+        self.assertIsInstance(engines["django"].engine.template_loaders[0], CachedLoader)
+
+    def test_warm_up(self):
+        names = warm_up_templates(["account", "payment"])
+
+        self.assertIn("account/register_mail.html", names)
+        self.assertIn("payment/facture.html", names)
+        self.assertNotIn("admin/base.html", names)
+        with patch.object(FilesystemLoader, "get_contents") as contents_mock:
+            get_template("account/register_mail.html")
+            get_template("payment/facture.html")
+        self.assertFalse(contents_mock.called)
+
+    def test_settings(self):
+        with self.settings(TEMPLATE_WARMUP_DIRS=["payment"]):
+            names = warm_up_templates()
+        self.assertEqual(names, ["payment/facture.html", "payment/notifications.html", "payment/subscription.html"])
+
+
+class TestUniqueMigrations(TransactionTestCase):
+    """
+        The duplicates left by the old code are cleaned before the unique constraints are added
+    """
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_cards(self):
+        apps = self.migrate([("account", "0004_outgoingemail")])
+        user = apps.get_model("account", "User").objects.create(username="guillaume", email="te@test.com")
+        SaveCardUser = apps.get_model("account", "SaveCardUser")
+        for available in (True, False, False):
+            SaveCardUser.objects.create(first_name="g", last_name="t", card_id="card_1", user=user,
+                                        card_exp_date=datetime.date.today(), card_available=available)
+        last = SaveCardUser.objects.latest("id")
+        self.migrate([("account", "0005_indexes")])
+
+        card = SaveCardUser.objects.get()
+        self.assertEqual(card.pk, last.pk)
+        self.assertTrue(card.card_available)
+
+    def test_shared_cards(self):
+        apps = self.migrate([("account", "0004_outgoingemail")])
+        User = apps.get_model("account", "User")
+        SaveCardUser = apps.get_model("account", "SaveCardUser")
+        for name in ("a", "b"):
+            SaveCardUser.objects.create(first_name="g", last_name="t", card_id="card_1",
+                                        card_exp_date=datetime.date.today(),
+                                        user=User.objects.create(username=name, email="%s@test.com" % name))
+        migration = import_module("account.migrations.0005_indexes")
+
+        with self.assertRaisesRegex(RuntimeError, "card_1"):
+            migration.merge_duplicate_cards(apps, None)
+        SaveCardUser.objects.all().delete()
+
+    def test_products(self):
+        apps = self.migrate([("payment", "0002_payplugnotification")])
+        subscription = apps.get_model("payment", "Subscription").objects.create(name="gold", description="test")
+        Product = apps.get_model("payment", "Product")
+        products = [Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                           duration=50, subscription=subscription) for _ in range(3)]
+        self.migrate([("payment", "0003_product_unique_name")])
+
+        names = list(Product.objects.order_by("id").values_list("name", flat=True))
+        self.assertEqual(names, ["test #%d" % products[0].pk, "test #%d" % products[1].pk, "test"])
+
+
+@skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN of SQLite")
+class TestQueryPlans(TestCase):
+    """
+        The queries of the payment hot paths use the indexes, instead of scanning their table
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="guillaume", email="te@test.com", accreditation=2)
+        cls.subscription = Subscription.objects.create(name="gold", description="test")
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return " / ".join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index):
+        plan = self.get_plan(queryset)
+        self.assertIn("INDEX %s" % index, plan)
+
+    def test_last_validate_payment(self):
+        payments = self.user.payments.filter(status="is_paid", subscribed_until__gte=datetime.date.today())
+        self.assertUsesIndex(payments.order_by("-id"), "account_pay_user_status_idx")
+        self.assertUsesIndex(self.user.payments.filter(status="is_paid"), "account_pay_user_status_idx")
+
+    def test_paid_by_date(self):
+        payments = PaymentsUser.objects.filter(status="is_paid", subscribed_until=datetime.date.today())
+        self.assertUsesIndex(payments, "account_pay_paid_until_idx")
+
+    def test_display_payments(self):
+        payments = self.user.payments.filter(date__lt=datetime.date.today()).order_by("-date", "-id")
+        self.assertUsesIndex(payments, "account_pay_user_date_idx")
+
+    def test_validate_card(self):
+        cards = self.user.card.filter(card_available=True, card_exp_date__gte=datetime.date.today())
+        self.assertUsesIndex(cards, "account_card_user_valid_idx")
+        self.assertIn("INDEX", self.get_plan(SaveCardUser.objects.filter(card_id="card_1")))  # Unique
+
+    def test_tokens(self):
+        for model in (ValidateUser, ResetUserPassword):
+            self.assertIn("INDEX", self.get_plan(model.objects.valid().filter(token=uuid.uuid4())))  # Unique
+            self.assertIn("INDEX", self.get_plan(model.objects.expired()))
+
+    def test_product(self):
+        products = Product.objects.filter(subscription=self.subscription, name="test")
+        self.assertIn("USING INDEX payment_product_subscription_id_name", self.get_plan(products))  # Unique
+
+
+class TestPurgeExpiredTokens(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="guillaume", email="te@test.com", accreditation=0)
+
+    def test_purge(self):
+        for i in range(5):
+            ValidateUser.objects.create(user=self.user, expires=timezone.now() - datetime.timedelta(seconds=1))
+        valid = ValidateUser.objects.create(user=self.user)
+        ResetUserPassword.objects.create(user=self.user, expires=timezone.now())
+
+        with self.assertNumQueries(6):  # 3 batches of ValidateUser, with their select then delete
+            self.assertEqual(ValidateUser.purge_expired(batch_size=2), 5)
+        self.assertEqual(list(ValidateUser.objects.all()), [valid])
+
+        stdout = StringIO()
+        call_command("purge_expired_tokens", stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "ValidateUser: 0 expired tokens deleted\n"
+                                            "ResetUserPassword: 1 expired tokens deleted\n")
+
+    def test_lifetime(self):
+        with self.settings(VALIDATE_TOKEN_LIFETIME=60):
+            token = ValidateUser.objects.create(user=self.user)
+        self.assertAlmostEqual((token.expires - timezone.now()).total_seconds(), 60, delta=5)
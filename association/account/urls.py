@@ -2,7 +2,8 @@ from django.conf.urls import url
 from django.contrib.auth.views import LogoutView
 
 from .views import DashboardView, RegisterView, ResendEmailView, ForgotPasswordView, validate, ResetPasswordView, \
-    ChangePasswordView, CustomLoginView, DisplayPayments, UpdateUserFields, DownloadPayment, unsubscribe, SeeUserData
+    ChangePasswordView, CustomLoginView, DisplayPayments, UpdateUserFields, DownloadPayment, unsubscribe, SeeUserData, \
+    ExportPayments
 
 urlpatterns = [
     url(r'^$', view=DashboardView.as_view(), name="dashboard"),
@@ -19,4 +20,5 @@ urlpatterns = [
     url(r'^change_password/$', view=ChangePasswordView.as_view(), name="change_password"),
     url(r'^display_payments/$', view=DisplayPayments.as_view(), name="display_payments"),
     url(r'^download/(?P<pk>.+)/$', view=DownloadPayment.as_view(), name="download"),
+    url(r'^export/$', view=ExportPayments.as_view(), name="export"),
 ]
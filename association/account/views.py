@@ -1,18 +1,22 @@
 from django.contrib.auth.forms import SetPasswordForm
-from django.core.exceptions import ValidationError
 from django.urls import reverse, reverse_lazy
-from django.http import HttpResponseRedirect
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.http import HttpResponseRedirect, FileResponse, StreamingHttpResponse, Http404, HttpResponseBadRequest
+from django.utils.dateparse import parse_date
 from django.contrib.auth import login as auth_login
 from django.contrib.auth.views import PasswordChangeView, LoginView
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.views.generic import TemplateView, CreateView, FormView, ListView, DetailView
+from django.views.generic import View, TemplateView, CreateView, FormView, ListView, DetailView
 from django.views.generic.edit import UpdateView
 from django_weasyprint import WeasyTemplateResponseMixin
+from django_weasyprint.views import CONTENT_TYPE_PDF
 
 from .forms import CustomUserForm, ResendEmailForm, ForgotPasswordForm
 from .models import User, ValidateUser, ResetUserPassword, PaymentsUser
 from .email import send_register_mail, send_reset_password_mail
-from .api import AnonymousRequiredMixin, accreditation_view_required
+from .invoices import INVOICE_FIELDS, get_invoice_key, get_cached_invoice, get_export_queryset, stream_invoices_zip
+from .api import AnonymousRequiredMixin, KeysetPaginationMixin, accreditation_view_required
 
 
 class CustomLoginView(LoginView):
@@ -70,7 +74,10 @@ class ResendEmailView(AnonymousRequiredMixin, FormView):
         except(KeyError, User.DoesNotExist):
             return HttpResponseRedirect(reverse_lazy(u"resend"))
         else:
-            token = ValidateUser.objects.get(user=user).token
+            validate_user = ValidateUser.objects.valid().filter(user=user).order_by("-expires").first()
+            if validate_user is None:  # Expired or already used
+                validate_user = ValidateUser.objects.create(user=user)
+            token = validate_user.token
             link = self.request.build_absolute_uri(reverse("validate", kwargs={'token': token}))
             send_register_mail(link, user.username, user.email, "test")
         return HttpResponseRedirect(self.get_success_url())
@@ -112,17 +119,14 @@ class ResetPasswordView(AnonymousRequiredMixin, FormView):
 
     def dispatch(self, request, *args, **kwargs):
         if "token" in kwargs:
-            token = kwargs["token"]
-            try:
-                self.user = ResetUserPassword.objects.get(token=token).user
-            except(KeyError, ResetUserPassword.DoesNotExist, ValidationError):
-                return HttpResponseRedirect(reverse_lazy(u"dashboard"))
-            else:
+            self.user = ResetUserPassword.get_user(kwargs["token"])
+            if self.user is not None:
                 return super().dispatch(request, *args, **kwargs)
         return HttpResponseRedirect(reverse_lazy(u"dashboard"))
 
     def form_valid(self, form):
         self.object = form.save()
+        ResetUserPassword.consume(self.kwargs["token"])
         return HttpResponseRedirect(reverse_lazy(u"login"))
 
 
@@ -135,32 +139,96 @@ class ChangePasswordView(LoginRequiredMixin, PasswordChangeView):
         return HttpResponseRedirect(reverse_lazy(u"dashboard"))
 
 
-class DisplayPayments(LoginRequiredMixin, ListView):
+class DisplayPayments(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     template_name = "account/display_payments.html"
     context_object_name = "payments"
-    paginate_by = 1
 
     def get_queryset(self):
-        return self.request.user.get_all_payments().order_by("-date")
+        return self.request.user.get_all_payments().select_related("product", "subscription")
 
 
 class DownloadPayment(LoginRequiredMixin, WeasyTemplateResponseMixin, DetailView):
     template_name = "payment/facture.html"
-    queryset = PaymentsUser.objects.all()
     context_object_name = "payment"
 
+    def get_queryset(self):
+        """
+        Only the payments of the user, with the columns of the invoice loaded at once.
+        """
+        return PaymentsUser.objects.filter(user=self.request.user) \
+                                   .select_related("product", "subscription", "user").only(*INVOICE_FIELDS)
+
+    def get_object(self, queryset=None):
+        """
+        The payment is given by its primary key, or by its reference.
+        """
+        if queryset is None:
+            queryset = self.get_queryset()
+        lookup = self.kwargs["pk"]
+        try:
+            if lookup.isdecimal():  # Unlike isdigit(), only what int() accepts
+                return queryset.get(pk=lookup)
+            return queryset.get(reference=lookup)
+        except PaymentsUser.DoesNotExist:
+            raise Http404("No payment found matching the query")
+
+    def get(self, request, *args, **kwargs):
+        """
+        The invoice of a paid payment never changes: it's rendered once, then served from the cache.
+        """
+        self.object = self.get_object()
+        if self.object.status != "is_paid":
+            return self.render_to_response(self.get_context_data(object=self.object))
+
+        stylesheets = self.get_pdf_stylesheets()
+        key = get_invoice_key(self.object, self.template_name, stylesheets)
+        etag = quote_etag(key)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            path = get_cached_invoice(self.object, self.template_name, stylesheets, key=key)
+            response = FileResponse(open(path, "rb"), content_type=CONTENT_TYPE_PDF)
+            filename = self.get_pdf_filename()
+            if filename:
+                response['Content-Disposition'] = '{}filename="{}"'.format(
+                    'attachment;' if self.pdf_attachment else 'inline;', filename)
+        response['ETag'] = etag
+        return response
+
+
+class ExportPayments(LoginRequiredMixin, View):
+    """
+    All the invoices of the paid payments in one ZIP, streamed as the invoices are rendered: the only bulk format.
+    Filtered by date with ?start= and ?end= (YYYY-MM-DD). A user exports his own invoices, the staff exports
+    the invoices of every user or of one with ?user=<pk>.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get("format", "zip") != "zip":
+            return HttpResponseBadRequest()
+        try:
+            start = parse_date(request.GET.get("start", ""))
+            end = parse_date(request.GET.get("end", ""))
+            if request.user.is_staff:
+                user = int(request.GET["user"]) if request.GET.get("user") else None
+            else:
+                user = request.user
+        except ValueError:
+            return HttpResponseBadRequest()
+        payments = get_export_queryset(user=user, start=start, end=end)
+
+        response = StreamingHttpResponse(stream_invoices_zip(payments), content_type="application/zip")
+        response['Content-Disposition'] = 'attachment;filename="factures.zip"'
+        return response
+
 
 # If connected and no validate email only
 @accreditation_view_required(perm=0, strict=True, redirect_url=reverse_lazy(u"dashboard"))
 def validate(request, token):
-    try:
-        validate_user = ValidateUser.objects.get(token=token)
-    except(KeyError, ValidateUser.DoesNotExist, ValidationError):
+    user = ValidateUser.consume(token)
+    if user is None:
         return HttpResponseRedirect(reverse_lazy(u"dashboard"))
-    else:
-        user = validate_user.user
-        user.accreditation = 1
-        user.save()
+    user.accreditation = 1
+    user.save()
     return HttpResponseRedirect(reverse_lazy(u"login"))
 
 
@@ -26,6 +26,13 @@ EMAIL_HOST_PASSWORD = 'guillaume98'  # my gmail password
 EMAIL_HOST_USER = 'gc.makina98@gmail.com'  # my gmail username
 EMAIL_PORT = 587
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+VALIDATE_TOKEN_LIFETIME = 7 * 24 * 3600  # Seconds a link validating an email address can be used
+RESET_PASSWORD_TOKEN_LIFETIME = 24 * 3600  # Seconds a link resetting a password can be used
+EMAIL_MAX_ATTEMPTS = 5  # Before a queued email is given up, see account.email.send_queued_mails
+EMAIL_RETRY_DELAY = 60  # Seconds before a queued email is tried again, doubled after each failure
+EMAIL_CLAIM_TIMEOUT = 600  # Seconds a batch of queued emails is kept by its worker, then taken by another one
+EMAIL_BATCH_SIZE = 50  # Messages sent at once by account.email.send_mass_mail_template
+EMAIL_MAX_RATE = 10  # Max messages per second, to stay under the limits of the SMTP provider
 
 # Application definition
 
@@ -68,6 +75,21 @@ TEMPLATES = [
     },
 ]
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Lists paged by account.api.KeysetPaginationMixin
+PAGE_SIZE = 10  # Rows per page
+MAX_PAGE_SIZE = 50  # Max rows per page asked with ?size=
+PAGE_COUNT = False  # Count the rows of all the pages, one more query per page
+
+CATALOGUE_CACHE_TIMEOUT = 3600  # Seconds, the catalogue is also invalidated when it changes, see payment.catalogue
+
+TEMPLATE_WARMUP_DIRS = []  # Templates compiled at the start of the workers, see association.warmup
+
 WSGI_APPLICATION = 'association.wsgi.application'
 
 
@@ -115,5 +137,40 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Invoices of paid payments, rendered once by account.invoices
+INVOICE_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'invoices')
+INVOICE_WORKERS = 2  # Processes rendering the invoices in background, 0 to render them on first download
+
+# HTML to PDF step of django_weasyprint, run out of the web workers
+WEASYPRINT_BACKEND = 'django_weasyprint.backends.ProcessPoolBackend'
+WEASYPRINT_BACKEND_OPTIONS = {
+    'workers': 2,
+    'max_tasks_per_child': 50,  # Recycle the processes to cap their memory
+    'max_queue': 100,
+    'timeout': 60,
+}
+
+# Jobs run by the run_scheduler command, see payment.scheduler
+# The schedules are given like in a crontab: minute hour day-of-month month day-of-week, in TIME_ZONE
+SCHEDULER_JOBS = {
+    'recurring_payments': {
+        'task': 'payment.api_payplug.find_recurring_payments',
+        'schedule': '0 2 * * *',
+        'jitter': 300,  # Max seconds added to the schedule, so the jobs of several sites don't hit Payplug at once
+    },
+    'checks': {
+        'task': 'payment.api_payplug.checks',
+        'schedule': '0 3 * * *',
+        'jitter': 300,
+    },
+    'purge_expired_tokens': {
+        'task': 'django.core.management.call_command',
+        'args': ['purge_expired_tokens'],
+        'schedule': '15 * * * *',
+    },
+}
+SCHEDULER_LOCK_TIMEOUT = 6 * 3600  # Seconds after which the lock of a job which never ended is taken over
+SCHEDULER_SLOW_FACTOR = 2  # A run longer than this times the average of the previous runs is reported
+
 LOGIN_REDIRECT_URL = reverse_lazy("dashboard")
 LOGOUT_REDIRECT_URL = reverse_lazy("dashboard")
@@ -0,0 +1,36 @@
+"""
+Production settings for association project: the development settings, with the debug off and the templates
+compiled once per worker.
+
+Use it with DJANGO_SETTINGS_MODULE=association.settings_production.
+"""
+
+import copy
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, TEMPLATES
+
+DEBUG = False
+
+# The cached loader keeps the compiled templates in memory: a template is parsed once per worker,
+# and the changes of the templates are seen after a restart only.
+TEMPLATES = copy.deepcopy(TEMPLATES)
+TEMPLATES[0]['APP_DIRS'] = False
+TEMPLATES[0]['OPTIONS']['loaders'] = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
+
+# Compiled when the wsgi application is loaded, see association.warmup
+TEMPLATE_WARMUP_DIRS = ['account', 'payment']
+
+# Shared by the workers: the catalogue invalidated by one of them is invalidated for all
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'django'),
+    }
+}
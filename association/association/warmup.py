@@ -0,0 +1,40 @@
+import os
+
+from django.conf import settings
+from django.template import engines
+
+
+def get_template_dirs(loaders):
+    """
+    The directories searched by the template loaders, through the cached loaders.
+    """
+    for loader in loaders:
+        if hasattr(loader, "loaders"):
+            for directory in get_template_dirs(loader.loaders):
+                yield directory
+        elif hasattr(loader, "get_dirs"):
+            for directory in loader.get_dirs():
+                yield directory
+
+
+def warm_up_templates(prefixes=None):
+    """
+    Compile the templates found under the given subdirectories of the template directories.
+    With the cached loader, the compiled templates are kept: the first requests of a worker don't parse them.
+
+    :param prefixes: Subdirectories like "account", settings.TEMPLATE_WARMUP_DIRS if None
+    :return: The names of the compiled templates
+    """
+    prefixes = settings.TEMPLATE_WARMUP_DIRS if prefixes is None else prefixes
+    names = []
+    for engine in engines.all():
+        loaders = getattr(getattr(engine, "engine", None), "template_loaders", ())
+        for directory in get_template_dirs(loaders):
+            for prefix in prefixes:
+                for root, dirs, files in os.walk(os.path.join(directory, prefix)):
+                    for filename in sorted(files):
+                        name = os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, "/")
+                        if name not in names:
+                            engine.get_template(name)
+                            names.append(name)
+    return names
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "association.settings")
 
 application = get_wsgi_application()
+
+from association.warmup import warm_up_templates  # noqa: E402, the apps are loaded by get_wsgi_application
+
+warm_up_templates()
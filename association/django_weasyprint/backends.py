@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import multiprocessing
+import tempfile
+import threading
+
+import weasyprint
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from .cache import font_config_kwargs, get_stylesheet
+
+DEFAULT_BACKEND = 'django_weasyprint.backends.InlineBackend'
+
+
+class BackendBusy(Exception):
+    """
+    Raised when too many documents are already waiting to be rendered.
+    """
+
+
+def write_document(html, base_url=None, url_fetcher=None, stylesheets=(), png=False, to_file=False):
+    """
+    Render HTML to a PDF or PNG document.
+    Module-level function, so it can be run in another process.
+
+    :param html: The HTML to render
+    :param base_url: Base URL to fetch CSS files, images, fonts, etc. from
+    :param url_fetcher: A picklable function, :func:`weasyprint.default_url_fetcher` if None
+    :param stylesheets: Stylesheet filenames or URLs
+    :param png: Write a PNG instead of a PDF
+    :param to_file: Write the document in a temporary file instead of returning it
+    :return: The document as bytes, or the path of the temporary file
+    """
+    url_fetcher = url_fetcher or weasyprint.default_url_fetcher
+    css = [get_stylesheet(value, base_url=base_url, url_fetcher=url_fetcher) for value in stylesheets]
+    document = weasyprint.HTML(string=html, base_url=base_url, url_fetcher=url_fetcher) \
+        .render(css, **font_config_kwargs())
+    content = document.write_png() if png else document.write_pdf()
+    if not to_file:
+        return content
+    with tempfile.NamedTemporaryFile(suffix='.png' if png else '.pdf', delete=False) as output:
+        output.write(content)
+    return output.name
+
+
+class InlineBackend(object):
+    """
+    Render the documents in the current thread.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    def render(self, html, base_url=None, url_fetcher=None, stylesheets=(), png=False, to_file=False):
+        """
+        :see :func:`write_document`
+        """
+        return write_document(html, base_url=base_url, url_fetcher=url_fetcher, stylesheets=stylesheets, png=png,
+                              to_file=to_file)
+
+    def close(self):
+        pass
+
+
+class ProcessPoolBackend(InlineBackend):
+    """
+    Render the documents in a pool of long-lived processes, so the layout doesn't block the web worker
+    nor grows its memory. Each process is replaced after max_tasks_per_child documents to cap its memory.
+
+    The url_fetcher given to :meth:`render` must be picklable, a module-level function for example.
+    """
+
+    def __init__(self, workers=2, max_tasks_per_child=50, max_queue=100, timeout=60, **options):
+        """
+        :param workers: Number of processes
+        :param max_tasks_per_child: Documents rendered by a process before it is replaced
+        :param max_queue: Max number of documents waiting or being rendered, :class:`BackendBusy` is raised beyond
+        :param timeout: Seconds to wait for a document, :class:`multiprocessing.TimeoutError` is raised beyond
+        """
+        super(ProcessPoolBackend, self).__init__(**options)
+        self.workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.get_context('spawn').Pool(
+                    self.workers, maxtasksperchild=self.max_tasks_per_child)
+            return self._pool
+
+    def render(self, html, base_url=None, url_fetcher=None, stylesheets=(), png=False, to_file=False):
+        """
+        :see :func:`write_document`
+        """
+        if url_fetcher is weasyprint.default_url_fetcher:
+            url_fetcher = None
+        if not self._slots.acquire(False):
+            raise BackendBusy('Too many documents waiting to be rendered')
+        try:
+            result = self.pool.apply_async(write_document, (html, base_url, url_fetcher, list(stylesheets), png,
+                                                            to_file))
+            return result.get(timeout=self.timeout)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Returns the backend set by `settings.WEASYPRINT_BACKEND`, with the options of
+    `settings.WEASYPRINT_BACKEND_OPTIONS`.
+    """
+    global _backend
+    if _backend is None:
+        backend_class = import_string(getattr(settings, 'WEASYPRINT_BACKEND', DEFAULT_BACKEND))
+        _backend = backend_class(**getattr(settings, 'WEASYPRINT_BACKEND_OPTIONS', {}))
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replace the backend of the current process, for example in a process which can't have children.
+    """
+    global _backend
+    if _backend is not None and _backend is not backend:
+        _backend.close()
+    _backend = backend
+
+
+def reset_backend(**kwargs):
+    if kwargs.get('setting') in (None, 'WEASYPRINT_BACKEND', 'WEASYPRINT_BACKEND_OPTIONS'):
+        set_backend(None)
+
+
+setting_changed.connect(reset_backend)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import mimetypes
+import os
+import threading
+
+import weasyprint
+from django.conf import settings
+from django.utils.six.moves.urllib.parse import urlparse, unquote
+
+try:
+    from weasyprint.text.fonts import FontConfiguration
+except ImportError:
+    try:
+        from weasyprint.fonts import FontConfiguration
+    except ImportError:  # WeasyPrint without @font-face support
+        FontConfiguration = None
+
+_lock = threading.Lock()
+_stylesheets = {}  # (filename, base_url, url_fetcher): (mtime, weasyprint.CSS)
+_files = {}  # path: (mtime, content)
+_font_config = None
+
+
+def get_font_config():
+    """
+    Returns the FontConfiguration shared by every document of the process, None if WeasyPrint has none.
+    """
+    global _font_config
+    if FontConfiguration is not None and _font_config is None:
+        with _lock:
+            if _font_config is None:
+                _font_config = FontConfiguration()
+    return _font_config
+
+
+def font_config_kwargs():
+    font_config = get_font_config()
+    return {'font_config': font_config} if font_config is not None else {}
+
+
+def get_stylesheet(value, base_url=None, url_fetcher=None):
+    """
+    Returns the parsed :class:`weasyprint.CSS` of a stylesheet.
+    Stylesheets given as a filename are parsed once per process, and again when the file is modified.
+
+    :param value: Filename or URL of the stylesheet
+    """
+    url_fetcher = url_fetcher or weasyprint.default_url_fetcher
+    if not os.path.isfile(value):
+        return weasyprint.CSS(value, base_url=base_url, url_fetcher=url_fetcher, **font_config_kwargs())
+
+    key = (value, base_url, url_fetcher)
+    mtime = os.path.getmtime(value)
+    cached = _stylesheets.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    css = weasyprint.CSS(value, base_url=base_url, url_fetcher=url_fetcher, **font_config_kwargs())
+    with _lock:
+        _stylesheets[key] = (mtime, css)
+    return css
+
+
+def find_local_file(url):
+    """
+    Path of the local file behind a `file://` URL or a URL of `settings.STATIC_URL`, None if there is none.
+    """
+    parsed = urlparse(url)
+    path = unquote(parsed.path)
+    if parsed.scheme == 'file':
+        return path if os.path.isfile(path) else None
+
+    static_path = urlparse(settings.STATIC_URL or '').path
+    if parsed.scheme not in ('http', 'https') or not static_path or not path.startswith(static_path):
+        return None
+    relative = path[len(static_path):]
+    directories = [getattr(settings, 'STATIC_ROOT', None)]
+    for directory in getattr(settings, 'STATICFILES_DIRS', ()):
+        directories.append(directory[1] if isinstance(directory, (list, tuple)) else directory)
+    for directory in directories:
+        if directory:
+            candidate = os.path.normpath(os.path.join(directory, relative))
+            if candidate.startswith(os.path.normpath(directory) + os.sep) and os.path.isfile(candidate):
+                return candidate
+    return None
+
+
+def cached_url_fetcher(url, *args, **kwargs):
+    """
+    URL fetcher serving the local files and the static files from memory, read once per process
+    and again when they are modified. Other URLs are fetched by :func:`weasyprint.default_url_fetcher`.
+    """
+    path = find_local_file(url)
+    if path is None:
+        return weasyprint.default_url_fetcher(url, *args, **kwargs)
+
+    mtime = os.path.getmtime(path)
+    cached = _files.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as local_file:
+            cached = (mtime, local_file.read())
+        with _lock:
+            _files[path] = cached
+    return {
+        'string': cached[1],
+        'mime_type': mimetypes.guess_type(path)[0],
+        'redirected_url': url,
+    }
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from .backends import BackendBusy, InlineBackend, ProcessPoolBackend, get_backend
+from .cache import cached_url_fetcher, get_stylesheet
+
+HTML = '<html><body><p>Facture</p></body></html>'
+
+
+class TestInlineBackend(SimpleTestCase):
+    def test_render(self):
+        self.assertTrue(InlineBackend().render(HTML).startswith(b'%PDF'))
+
+    def test_render_to_file(self):
+        path = InlineBackend().render(HTML, to_file=True)
+        with open(path, 'rb') as pdf:
+            self.assertTrue(pdf.read().startswith(b'%PDF'))
+        os.remove(path)
+
+
+class TestProcessPoolBackend(SimpleTestCase):
+    def setUp(self):
+        self.backend = ProcessPoolBackend(workers=1, max_tasks_per_child=1, timeout=60)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def test_render(self):
+        self.assertTrue(self.backend.render(HTML).startswith(b'%PDF'))
+        self.assertTrue(self.backend.render(HTML).startswith(b'%PDF'))  # In a recycled process
+
+    def test_render_to_file(self):
+        path = self.backend.render(HTML, to_file=True)
+        with open(path, 'rb') as pdf:
+            self.assertTrue(pdf.read().startswith(b'%PDF'))
+        os.remove(path)
+
+    def test_queue_limit(self):
+        backend = ProcessPoolBackend(max_queue=0)
+        with self.assertRaises(BackendBusy):
+            backend.render(HTML)
+
+    def test_timeout(self):
+        self.backend.timeout = 0
+        with self.assertRaises(multiprocessing.TimeoutError):
+            self.backend.render(HTML)
+
+
+class TestGetBackend(SimpleTestCase):
+    def test_setting(self):
+        with override_settings(WEASYPRINT_BACKEND='django_weasyprint.backends.ProcessPoolBackend',
+                               WEASYPRINT_BACKEND_OPTIONS={'workers': 3}):
+            backend = get_backend()
+            self.assertIsInstance(backend, ProcessPoolBackend)
+            self.assertEqual(backend.workers, 3)
+        with override_settings(WEASYPRINT_BACKEND='django_weasyprint.backends.InlineBackend'):
+            self.assertIsInstance(get_backend(), InlineBackend)
+
+
+class TestCache(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.css = os.path.join(self.directory, 'facture.css')
+        self.write(self.css, b'p { color: red }', mtime=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def write(path, content, mtime):
+        with open(path, 'wb') as css:
+            css.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def test_stylesheet(self):
+        css = get_stylesheet(self.css)
+        self.assertIs(get_stylesheet(self.css), css)
+
+        self.write(self.css, b'p { color: blue }', mtime=2000)
+        self.assertIsNot(get_stylesheet(self.css), css)
+
+    def test_fetch_file(self):
+        url = 'file://' + self.css
+        self.assertEqual(cached_url_fetcher(url)['string'], b'p { color: red }')
+
+        self.write(self.css, b'p { color: blue }', mtime=1000)  # Same mtime, still in memory
+        self.assertEqual(cached_url_fetcher(url)['string'], b'p { color: red }')
+
+        self.write(self.css, b'p { color: blue }', mtime=2000)
+        self.assertEqual(cached_url_fetcher(url)['string'], b'p { color: blue }')
+
+    def test_fetch_static(self):
+        with override_settings(STATIC_URL='/static/', STATICFILES_DIRS=[self.directory]):
+            fetched = cached_url_fetcher('https://akuket.pythonanywhere.com/static/facture.css')
+
+        self.assertEqual(fetched['string'], b'p { color: red }')
+        self.assertEqual(fetched['mime_type'], 'text/css')
+
+    @patch('weasyprint.default_url_fetcher')
+    def test_fetch_outside_static(self, fetcher_mock):
+        url = 'https://akuket.pythonanywhere.com/static/../facture.css'
+        with override_settings(STATIC_URL='/static/', STATICFILES_DIRS=[os.path.join(self.directory, 'static')]):
+            cached_url_fetcher(url)
+
+        fetcher_mock.assert_called_once_with(url)
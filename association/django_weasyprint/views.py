@@ -4,8 +4,14 @@ from __future__ import unicode_literals
 import weasyprint
 from django.conf import settings
 from django.template.response import TemplateResponse
+from django.utils.module_loading import import_string
 from django.views.generic.base import ContextMixin, TemplateResponseMixin, View
 
+from .backends import get_backend
+from .cache import font_config_kwargs, get_stylesheet
+
+DEFAULT_URL_FETCHER = 'django_weasyprint.cache.cached_url_fetcher'
+
 CONTENT_TYPE_PNG = 'image/png'
 CONTENT_TYPE_PDF = 'application/pdf'
 
@@ -49,16 +55,17 @@ class WeasyTemplateResponse(TemplateResponse):
         """
         Determine the URL fetcher to fetch CSS, images, fonts, etc. from.
 
-        This just returns the default URL fetcher from Weasyprint, and is meant
-        to be overridden in subclasses.
+        This returns `settings.WEASYPRINT_URL_FETCHER`, by default a fetcher
+        serving the local and static files from memory, and is meant to be
+        overridden in subclasses.
         """
-        return weasyprint.default_url_fetcher
+        return import_string(getattr(settings, 'WEASYPRINT_URL_FETCHER', DEFAULT_URL_FETCHER))
 
     def get_css(self, base_url, url_fetcher):
         tmp = []
         for value in self._stylesheets:
             # TODO test with missing or invalid css
-            css = weasyprint.CSS(value, base_url=base_url,
+            css = get_stylesheet(value, base_url=base_url,
                                  url_fetcher=url_fetcher)
             if css:
                 tmp.append(css)
@@ -81,17 +88,31 @@ class WeasyTemplateResponse(TemplateResponse):
             base_url=base_url,
             url_fetcher=url_fetcher,
         )
-        return html.render(self.get_css(base_url, url_fetcher))
+        return html.render(self.get_css(base_url, url_fetcher), **font_config_kwargs())
+
+    def render_document(self, to_file=False):
+        """
+        Renders the document with the backend set by `settings.WEASYPRINT_BACKEND`.
+
+        :param to_file: Write the document in a temporary file instead of returning it
+        :return: The document as bytes, or the path of the temporary file
+        """
+        base_url = self.get_base_url()
+        return get_backend().render(
+            super(WeasyTemplateResponse, self).rendered_content,
+            base_url=base_url,
+            url_fetcher=self.get_url_fetcher(),
+            stylesheets=self._stylesheets,
+            png=CONTENT_TYPE_PNG in (self._content_type or ''),
+            to_file=to_file,
+        )
 
     @property
     def rendered_content(self):
         """
         Returns rendered PDF pages.
         """
-        document = self.get_document()
-        if CONTENT_TYPE_PNG in self._content_type:
-            return document.write_png()
-        return document.write_pdf()
+        return self.render_document()
 
 
 class WeasyTemplateResponseMixin(TemplateResponseMixin):
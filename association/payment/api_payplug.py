@@ -1,25 +1,71 @@
 import datetime
+import json
+import time
 import uuid
+from collections import namedtuple
 
 import payplug
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
 
+from account.invoices import schedule_invoice
 from account.models import PaymentsUser, SaveCardUser, User
-from .config import SECRET_KEY
+from .config import SECRET_KEY, PAYPLUG_FLUSH_SIZE
+from .models import PayplugNotification
+from .executor import PayplugExecutor
+from .sweep import sweep
+from . import network
 
 payplug.set_secret_key(SECRET_KEY)
+network.install()  # Keep-alive connections to Payplug, shared by all the calls
 
 PAID_PAYMENT_STATUS = "is_paid"
 
+Renewal = namedtuple("Renewal", ("user", "card", "product", "subscription"))
 
-def create_classic_payment(user, subscription, product, data=None):
+
+class RenewalReport(object):
     """
-    Create a classic payment with Payplug
+    Summary of a run of find_recurring_payments()
+    """
+
+    def __init__(self, users=0, payments=0, seconds=0.0, errors=None):
+        self.users = users  # Users due for a renewal
+        self.payments = payments  # Payments accepted by Payplug and stored in db
+        self.seconds = seconds
+        self.errors = errors or []  # (Renewal, exception) of the calls to Payplug or the writes which failed
+
+    @property
+    def rate(self):
+        """
+        Renewals handled per second
+        """
+        if self.seconds:
+            return self.users / self.seconds
+        return 0.0
+
+    @property
+    def rows(self):
+        """
+        Payments created, for payment.scheduler
+        """
+        return self.payments
+
+    def __repr__(self):
+        return "<RenewalReport users=%d payments=%d errors=%d seconds=%.3f rate=%.1f/s>" % (
+            self.users, self.payments, len(self.errors), self.seconds, self.rate)
+
+
+def prepare_classic_payment(user, subscription, product, data=None):
+    """
+    The data of a classic payment for Payplug, and its PaymentsUser to save once Payplug gave the reference
 
     :param user: The user related to the payment
     :param subscription: The subscription related to the payment
     :param product: The product related to the payment
     :param data: Optional parameter to complete the creation of the payment
-    :return: A redirect url to Payplug
+    :return: The data for payplug.Payment.create(), and the unsaved PaymentsUser without reference
     """
     token = uuid.uuid4()
     cents_price = 100 * product.price
@@ -39,9 +85,24 @@ def create_classic_payment(user, subscription, product, data=None):
         payment_data.update(data)
 
     subscribed_until = datetime.date.today() + datetime.timedelta(product.duration)
+    payment_user = PaymentsUser(subscription=subscription, product=product, user=user, price=product.price,
+                                tva=product.tva, subscribed_until=subscribed_until, token=token)
+    return payment_data, payment_user
+
+
+def create_classic_payment(user, subscription, product, data=None):
+    """
+    Create a classic payment with Payplug
+
+    :param user: The user related to the payment
+    :param subscription: The subscription related to the payment
+    :param product: The product related to the payment
+    :param data: Optional parameter to complete the creation of the payment
+    :return: A redirect url to Payplug
+    """
+    payment_data, payment_user = prepare_classic_payment(user, subscription, product, data)
     payment = payplug.Payment.create(**payment_data)  # Create the payment object
-    payment_user = PaymentsUser(reference=str(payment.id), subscription=subscription, product=product, user=user,
-                                price=product.price, tva=product.tva, subscribed_until=subscribed_until, token=token)
+    payment_user.reference = str(payment.id)
     payment_user.save()
     return payment
 
@@ -56,62 +117,90 @@ def make_recurring_payment(user, data=None):
     card_object = user.get_last_validate_card()
     product = user.get_product()
     subscription = user.get_subscription()
-    token = uuid.uuid4()
 
     if card_object is not None and product is not None and subscription is not None:
-        cents_price = 100 * product.price
-        if cents_price != int(cents_price):
-            raise ValueError("au centime pres")
-
-        payment_data = {
-            'amount': int(cents_price),  # In cents, 1 euro minimum
-            'customer': {'email': str(user.email), 'first_name': str(card_object.first_name),
-                         'last_name': str(card_object.last_name)},
-            'save_card': False,
-            'currency': 'EUR',
-            'payment_method': str(card_object.card_id),  # Important to make a recurring payment
-            'metadata': {
-                'token': token.hex,
-            },
-        }
-
-        if data:
-            payment_data.update(data)
-
-        duration = datetime.date.today() + datetime.timedelta(product.duration)
-        payment = payplug.Payment.create(**payment_data)  # creation de l'object payment
-        if payment.is_paid:
-            payment_user = PaymentsUser(reference=str(payment.id), subscription=subscription, product=product,
-                                        user=user, price=product.price, tva=product.tva, subscribed_until=duration,
-                                        token=token)
-            payment_user.save()
+        payment_user = create_recurring_payment(Renewal(user, card_object, product, subscription), data=data)
+        if payment_user is not None:
+            with transaction.atomic():
+                payment_user.save()
+                user.extend_membership(payment_user)
 
 
-def update_payment(payment_object):
+def create_recurring_payment(renewal, data=None):
     """
-    Update the payment next to the post of Payplug on the notification url
-    :param payment_object: Response provide by Payplug
+    Ask Payplug for the payment of a renewal, without storing it
+
+    :param renewal: The Renewal to pay, with the user, the card, the product and the subscription
+    :param data: Optional parameter to complete the creation of the payment
+    :return: An unsaved PaymentsUser if the payment is done, else None
     """
-    status = None
-    payment = PaymentsUser.objects.get(reference=str(payment_object.id))
-    if payment_object.object == 'payment' and payment_object.is_paid:  # Update user's subscription if the payment is done
-        if payment_object.metadata["token"] == payment.token.hex:
-            status = PAID_PAYMENT_STATUS
-            update_user(payment_object=payment_object, user=payment.user)
+    user, card_object, product, subscription = renewal
+    token = uuid.uuid4()
+    cents_price = 100 * product.price
+    if cents_price != int(cents_price):
+        raise ValueError("au centime pres")
 
-        else:
-            status = "Fraud_suspected"
-            payment.error_message = "Caution, the token provided not match with the token stored in data base"
+    payment_data = {
+        'amount': int(cents_price),  # In cents, 1 euro minimum
+        'customer': {'email': str(user.email), 'first_name': str(card_object.first_name),
+                     'last_name': str(card_object.last_name)},
+        'save_card': False,
+        'currency': 'EUR',
+        'payment_method': str(card_object.card_id),  # Important to make a recurring payment
+        'metadata': {
+            'token': token.hex,
+        },
+    }
 
-    elif payment_object.object == 'payment' and payment_object.failure:  # An error is occurred
-        status = str(payment_object.failure.code)
-        payment.error_message = str(payment_object.failure.message)
+    if data:
+        payment_data.update(data)
 
-    # elif response.object == 'refund':  # The refund method
-    #    pass
+    duration = datetime.date.today() + datetime.timedelta(product.duration)
+    payment = payplug.Payment.create(**payment_data)  # creation de l'object payment
+    if payment.is_paid:
+        return PaymentsUser(reference=str(payment.id), subscription=subscription, product=product, user=user,
+                            price=product.price, tva=product.tva, subscribed_until=duration, token=token)
+    return None
 
-    payment.status = status
-    payment.save()
+
+def update_payment(payment_object):
+    """
+    Update the payment next to the post of Payplug on the notification url.
+    Everything is done in a single transaction, with the payment locked. A payment already paid is left untouched,
+    since Payplug posts the same notification again until it gets an answer.
+
+    :param payment_object: Response provide by Payplug
+    :return: The payment updated
+    """
+    with transaction.atomic():
+        payment = PaymentsUser.objects.select_for_update().select_related("user") \
+                                      .get(reference=str(payment_object.id))
+        if payment.status == PAID_PAYMENT_STATUS:
+            return payment
+
+        status = None
+        if payment_object.object == 'payment' and payment_object.is_paid:  # Update user's subscription if paid
+            if payment_object.metadata["token"] == payment.token.hex:
+                status = PAID_PAYMENT_STATUS
+                update_user(payment_object=payment_object, user=payment.user)
+                payment.user.extend_membership(payment)
+
+            else:
+                status = "Fraud_suspected"
+                payment.error_message = "Caution, the token provided not match with the token stored in data base"
+
+        elif payment_object.object == 'payment' and payment_object.failure:  # An error is occurred
+            status = str(payment_object.failure.code)
+            payment.error_message = str(payment_object.failure.message)
+
+        # elif response.object == 'refund':  # The refund method
+        #    pass
+
+        payment.status = status
+        payment.save(update_fields=["status", "error_message", "date"])
+        if status == PAID_PAYMENT_STATUS:
+            schedule_invoice(payment)
+    return payment
 
 
 def update_user(payment_object, user):
@@ -124,7 +213,7 @@ def update_user(payment_object, user):
     if payment_object.save_card:  # Store the blank card in db
         save_card(response=payment_object, user=user)
 
-    user.set_accreditation(2)
+    user.set_accreditation(2, update_fields=["accreditation"])  # The user was just loaded, nothing else changed
 
 
 def save_card(response, user):
@@ -133,34 +222,211 @@ def save_card(response, user):
 
     :param response: An api provide by Payplug to manage the post response of the Payplug's site for the payment.
     :param user: The user related to the payment
+    :return: The card stored in db
+    """
+    card, _ = SaveCardUser.objects.get_or_create(card_id=response.card.id, defaults={
+        'first_name': response.customer.first_name,
+        'last_name': response.customer.last_name,
+        'card_exp_date': datetime.date(response.card.exp_year, response.card.exp_month, 30),
+        'user': user,
+    })
+    return card
+
+
+def load_due_renewals(today=None):
+    """
+    Load the users to renew today, each one with his last validate card, product and subscription.
+    Works in a fixed number of queries, whatever the number of users.
+    Users without a validate card lose their subscription, like with User.get_last_validate_card().
+    Users already renewed are left out, so a second run doesn't charge them again: those with a paid payment going
+    past today, or with one made today whose notification hasn't come yet.
+
+    :param today: Date of the renewal, today by default
+    :return: A list of Renewal, one per user
+    """
+    today = today or datetime.date.today()
+    waiting = Q(status="") | Q(status__isnull=True)
+    renewed = PaymentsUser.objects.filter(Q(status=PAID_PAYMENT_STATUS) | waiting & Q(date=today),
+                                          subscribed_until__gt=today).values("user_id")
+    user_ids = set(User.objects.filter(accreditation=2, payments__subscribed_until=today,
+                                       payments__product__recurrent=True).exclude(pk__in=renewed)
+                               .values_list("pk", flat=True))
+    if not user_ids:
+        return []
+
+    payments = {}
+    for payment in PaymentsUser.objects.filter(user__in=user_ids, status=PAID_PAYMENT_STATUS,
+                                               subscribed_until__gte=today) \
+                                       .select_related("user", "product", "subscription").order_by("user", "-id"):
+        payments.setdefault(payment.user_id, payment)  # Only keep the last validate payment
+
+    cards = {}
+    for card in SaveCardUser.objects.filter(user__in=user_ids, card_available=True, card_exp_date__gte=today) \
+                                    .order_by("user", "-id"):
+        cards.setdefault(card.user_id, card)  # Only keep the last validate card
+
+    without_card = user_ids - set(cards)
+    if without_card:
+        User.objects.filter(pk__in=without_card).update(accreditation=1)
+
+    return [Renewal(payment.user, cards[user_id], payment.product, payment.subscription)
+            for user_id, payment in sorted(payments.items()) if user_id in cards]
+
+
+def find_recurring_payments(data=None, executor=None, flush_size=None):
+    """
+    Renew the subscription of every user whose recurring payment ends today.
+    The users are loaded in a fixed number of queries, Payplug is called concurrently,
+    and the new payments are stored by this thread as they come, flush_size at once in a short transaction,
+    so a write which fails only loses its chunk. The payments of such a chunk are reported in the errors,
+    since the cards are charged: they have to be stored by hand.
+
+    :param data: Optional parameter to complete the creation of the payments
+    :param executor: The PayplugExecutor running the calls to Payplug, a default one if None
+    :param flush_size: Payments stored per transaction, PAYPLUG_FLUSH_SIZE by default
+    :return: A RenewalReport of the run
     """
+    start = time.monotonic()
+    executor = executor or PayplugExecutor()
+    flush_size = flush_size or PAYPLUG_FLUSH_SIZE
+    renewals = load_due_renewals()
+    pending = []  # (Renewal, PaymentsUser) accepted by Payplug, not stored yet
+    errors = []
+    stored = 0
+    for outcome in executor.map(lambda renewal: create_recurring_payment(renewal, data=data), renewals):
+        if outcome.error is not None:
+            errors.append((outcome.item, outcome.error))
+        elif outcome.result is not None:
+            pending.append((outcome.item, outcome.result))
+        if len(pending) >= flush_size:
+            stored += store_renewals(pending, errors)
+            pending = []
+    stored += store_renewals(pending, errors)
+    return RenewalReport(users=len(renewals), payments=stored, seconds=time.monotonic() - start, errors=errors)
+
+
+def store_renewals(pending, errors):
+    """
+    Store the payments of renewals accepted by Payplug in a single transaction.
+
+    :param pending: List of (Renewal, PaymentsUser)
+    :param errors: List where the (Renewal, exception) of the payments which couldn't be stored are added
+    :return: The number of payments stored
+    """
+    if not pending:
+        return 0
+    payments_user = [payment for _, payment in pending]
     try:
-        SaveCardUser.objects.get(card_id=response.card.id)
-    except SaveCardUser.DoesNotExist:
-        first_name = response.customer.first_name
-        last_name = response.customer.last_name
-        card_id = response.card.id
-        card_exp_date = datetime.date(response.card.exp_year, response.card.exp_month, 30)
-        card = SaveCardUser(first_name=first_name, last_name=last_name, card_id=card_id,
-                            card_exp_date=card_exp_date, user=user)
-        card.save()
-
-
-def find_recurring_payments():
-    today = datetime.date.today()
+        with transaction.atomic():
+            PaymentsUser.objects.bulk_create(payments_user)
+            extend_memberships(payments_user)
+    except DatabaseError as e:
+        errors.extend((renewal, e) for renewal, _ in pending)
+        return 0
+    return len(payments_user)
+
+
+def extend_memberships(payments_user):
+    """
+    Record the subscriptions paid by the payments on their users, like User.extend_membership(),
+    with one query per end of subscription and product.
+
+    :param payments_user: Paid PaymentsUser
+    """
+    users = {}
+    for payment in payments_user:
+        users.setdefault((payment.subscribed_until, payment.product_id), []).append(payment.user_id)
+    for (subscribed_until, product_id), user_ids in users.items():
+        User.objects.filter(Q(active_until__isnull=True) | Q(active_until__lt=subscribed_until), pk__in=user_ids) \
+                    .update(active_until=subscribed_until, current_product=product_id)
+
+
+def enqueue_notification(body):
+    """
+    Store a notification posted by Payplug, without treating it
+
+    :param body: Raw body of the request posted on the notification url
+    :return: The PayplugNotification created
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
     try:
-        for user in User.objects.filter(accreditation=2, payments__subscribed_until=today,
-                                        payments__product__recurrent=True):
-            make_recurring_payment(user)
-    except TypeError:
-        pass
+        reference = str(json.loads(body).get("id", ""))
+    except (ValueError, AttributeError):
+        reference = ""
+    return PayplugNotification.objects.create(body=body, reference=reference[:255])
 
 
-def checks():
+def process_notifications(batch_size=100):
+    """
+    Treat the oldest pending notifications of the queue.
+    A notification is skipped if another one of the batch has the same reference,
+    or if its payment is already paid: Payplug posts the same notification again until it gets an answer.
+    A notification which can't be treated is marked as an error with its message, and the batch goes on,
+    so it never blocks the queue.
+
+    :param batch_size: Max number of notifications to treat
+    :return: The number of notifications taken from the queue
+    """
+    notifications = list(PayplugNotification.objects.filter(processed__isnull=True).order_by("id")[:batch_size])
+    references = [notification.reference for notification in notifications if notification.reference]
+    seen = set(PaymentsUser.objects.filter(reference__in=references, status=PAID_PAYMENT_STATUS)
+                                   .values_list("reference", flat=True))
+    for notification in notifications:
+        if notification.reference in seen:
+            notification.status = PayplugNotification.DUPLICATE
+        else:
+            try:
+                response = payplug.notifications.treat(notification.body)  # Full api provide by payplug
+            except Exception as error:
+                notification.status = PayplugNotification.ERROR
+                notification.error_message = ("%s: %s" % (type(error).__name__, error))[:255]
+            else:
+                notification.reference = str(response.id)
+                if notification.reference in seen:
+                    notification.status = PayplugNotification.DUPLICATE
+                else:
+                    try:
+                        update_payment(response)
+                    except PaymentsUser.DoesNotExist:
+                        notification.status = PayplugNotification.ERROR
+                        notification.error_message = "Unknown payment"
+                        seen.add(notification.reference)
+                    except Exception as error:  # Left for a check by hand, the next notifications are treated
+                        notification.status = PayplugNotification.ERROR
+                        notification.error_message = ("%s: %s" % (type(error).__name__, error))[:255]
+                    else:
+                        notification.status = PayplugNotification.DONE
+                        seen.add(notification.reference)
+        notification.processed = timezone.now()
+        notification.save(update_fields=["reference", "status", "error_message", "processed"])
+    return len(notifications)
+
+
+def notifications_queue_stats():
+    """
+    :return: The number of pending notifications, and the age in seconds of the oldest one
+    """
+    pending = PayplugNotification.objects.filter(processed__isnull=True)
+    oldest = pending.order_by("id").values_list("received", flat=True).first()
+    lag = (timezone.now() - oldest).total_seconds() if oldest is not None else 0.0
+    return {"depth": pending.count(), "lag": lag}
+
+
+def checks(batch_size=None):
     """
     Check if cards stored in db are already available
     Check user's accreditation on the site, based on subscription duration
+    Both are updated by chunks, see sweep.sweep()
+
+    :param batch_size: Rows updated per transaction, SWEEP_BATCH_SIZE by default
+    :return: The SweepReports of the cards and of the users
     """
     today = datetime.date.today()
-    SaveCardUser.objects.filter(card_available=True, card_exp_date__lt=today).update(card_available=False)
-    User.objects.filter(accreditation=2, payments__subscribed_until__lt=today).update(accreditation=1)
+    cards = SaveCardUser.objects.filter(card_available=True, card_exp_date__lt=today)
+    # Only the latest paid payment of each user counts: a user with a payment still running keeps his accreditation
+    paid = PaymentsUser.objects.filter(status=PAID_PAYMENT_STATUS)
+    users = User.objects.filter(accreditation=2, pk__in=paid.filter(subscribed_until__lt=today).values("user_id")) \
+                        .exclude(pk__in=paid.filter(subscribed_until__gte=today).values("user_id"))
+    return [sweep("cards", cards, {"card_available": False}, batch_size),
+            sweep("accreditations", users, {"accreditation": 1}, batch_size)]
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class PaymentConfig(AppConfig):
+    name = "payment"
+
+    def ready(self):
+        from . import catalogue  # noqa: F401, connect the signals invalidating the catalogue
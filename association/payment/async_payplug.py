@@ -0,0 +1,111 @@
+import asyncio
+import functools
+from concurrent import futures
+
+from django.db import close_old_connections
+from payplug import resources, routes
+from payplug.network import HttpClient
+
+from .api_payplug import prepare_classic_payment
+from .config import PAYPLUG_POOL_SIZE, PAYPLUG_CHECKOUT_TIMEOUT
+from .network import SessionRequest
+
+# Threads making the blocking HTTP calls of the coroutines, created on first use
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = futures.ThreadPoolExecutor(max_workers=PAYPLUG_POOL_SIZE)
+    return _executor
+
+
+# Thread running the queries of the coroutines, so the event loop never waits for the db. A single one, like the
+# thread sensitive mode of asgiref: the queries share its connection, and never run in the thread of the loop.
+_db_executor = None
+
+
+def get_db_executor():
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = futures.ThreadPoolExecutor(max_workers=1)
+    return _db_executor
+
+
+def _run_db(func, args, kwargs):
+    close_old_connections()  # Like at the start and the end of a request, the connection is per call
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Call a function which makes queries in the db thread, the ORM being synchronous only.
+
+    :return: The result of func
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(_run_db, func, args, kwargs))
+
+
+class AsyncPayplugClient(object):
+    """
+    Coroutines calling Payplug. The HTTP calls go through the pooled session in a pool of threads,
+    so the event loop keeps serving other requests while Payplug answers.
+    """
+
+    def __init__(self, timeout=PAYPLUG_CHECKOUT_TIMEOUT, executor=None):
+        """
+        :param timeout: Seconds before a call is abandoned
+        :param executor: Executor running the HTTP calls, the shared one if None
+        """
+        self.timeout = timeout
+        self.executor = executor or get_executor()
+        # The HTTP call is abandoned too, so it doesn't keep holding a thread of the executor. A second later,
+        # so the coroutine always gives up first, with an asyncio.TimeoutError
+        self.request_handler = type("TimeoutSessionRequest", (SessionRequest,), {"timeout": timeout + 1})
+
+    def _create_payment(self, data):
+        response, _ = HttpClient(request_handler=self.request_handler).post(routes.url(routes.PAYMENT_RESOURCE), data)
+        return resources.Payment(**response)
+
+    async def create_payment(self, **data):
+        """
+        Like payplug.Payment.create()
+
+        :return: The payment resource
+        :raise asyncio.TimeoutError: If Payplug didn't answer within the timeout
+        """
+        loop = asyncio.get_event_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.executor, self._create_payment, data), self.timeout)
+
+
+async def create_classic_payment_async(user, subscription, product, data=None, client=None):
+    """
+    Like api_payplug.create_classic_payment(), without blocking the event loop while Payplug answers.
+    No view uses it yet: under the WSGI server of Django 1.11, payment_view() and its blocking call are as fast.
+
+    :param client: The AsyncPayplugClient, a new one with the default timeout if None
+    :return: The payment resource, with the redirect url to Payplug
+    """
+    payment_data, payment_user = prepare_classic_payment(user, subscription, product, data)  # No query
+    payment = await (client or AsyncPayplugClient()).create_payment(**payment_data)
+    payment_user.reference = str(payment.id)
+    await run_db(payment_user.save)
+    return payment
+
+
+def run_coroutine(coroutine):
+    """
+    Run a coroutine to its end in a new event loop, from synchronous code which waits for it.
+
+    :return: The result of the coroutine
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
@@ -0,0 +1,101 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Subscription, Product
+
+CATALOGUE_CACHE_KEY = "payment:catalogue"
+PRODUCT_INDEX_CACHE_KEY = "payment:catalogue:products"
+CATALOGUE_FRAGMENT = "catalogue"  # Name of the {% cache %} fragment of payment/subscription.html
+
+
+def get_catalogue():
+    """
+    The subscriptions with their products, loaded in two queries and kept in the cache until the catalogue changes.
+
+    :return: A list of Subscription, subscription.products.all() doesn't hit the db
+    """
+    catalogue = cache.get(CATALOGUE_CACHE_KEY)
+    if catalogue is None:
+        catalogue = list(Subscription.objects.prefetch_related("products").order_by("id"))
+        cache.set(CATALOGUE_CACHE_KEY, catalogue, settings.CATALOGUE_CACHE_TIMEOUT)
+    return catalogue
+
+
+def get_product_index():
+    """
+    The products of the catalogue, indexed by (subscription name, product name) and by token.
+    Kept in the cache with the catalogue. The subscription of each product is loaded.
+
+    :return: A dict {(subscription name, product name): Product, token hex: Product}
+    """
+    index = cache.get(PRODUCT_INDEX_CACHE_KEY)
+    if index is None:
+        index = {}
+        for subscription in get_catalogue():
+            for product in subscription.products.all():
+                index.setdefault((subscription.name, product.name), product)
+                index[product.token.hex] = product
+        cache.set(PRODUCT_INDEX_CACHE_KEY, index, settings.CATALOGUE_CACHE_TIMEOUT)
+    return index
+
+
+def _find_missing_product(**lookup):
+    """
+    Look for a product missing from the cached index in the db: the cache of another process may have been the only
+    one invalidated when it was added. The index is dropped if it's found, to be loaded again with it.
+
+    :return: The product, None if it doesn't exist
+    """
+    product = Product.objects.select_related("subscription").filter(**lookup).order_by("id").first()
+    if product is not None:
+        invalidate_catalogue()
+    return product
+
+
+def find_product(subscription_name, product_name):
+    """
+    :return: The product of the catalogue, None if it doesn't exist
+    """
+    product = get_product_index().get((subscription_name, product_name))
+    if product is None:
+        product = _find_missing_product(subscription__name=subscription_name, name=product_name)
+    return product
+
+
+def find_product_by_token(token):
+    """
+    :param token: The token of the product, a UUID or its hex
+    :return: The product of the catalogue, None if it doesn't exist
+    """
+    if isinstance(token, uuid.UUID):
+        token = token.hex
+    product = get_product_index().get(token)
+    if product is None:
+        try:
+            product = _find_missing_product(token=uuid.UUID(token))
+        except ValueError:  # Not a token
+            product = None
+    return product
+
+
+def invalidate_catalogue():
+    """
+    Drop the cached catalogue and product index, and the template fragments rendered from the catalogue.
+    """
+    cache.delete_many([CATALOGUE_CACHE_KEY, PRODUCT_INDEX_CACHE_KEY, make_template_fragment_key(CATALOGUE_FRAGMENT)])
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def catalogue_changed(sender, **kwargs):
+    invalidate_catalogue()
+    # Again once committed: a request may have cached the old catalogue while the transaction was running
+    transaction.on_commit(invalidate_catalogue)
@@ -1 +1,17 @@
 SECRET_KEY = 'sk_test_5FVRtiAo2p1luWvHMmHa8z'
+
+# Calls to Payplug made by the recurring payments, see executor.PayplugExecutor
+PAYPLUG_WORKERS = 4  # Max number of concurrent calls
+PAYPLUG_TIMEOUT = 30  # Seconds before a call is abandoned, retries included
+PAYPLUG_RETRIES = 2  # Retries of a call whose request could not be sent, see executor.is_never_sent
+PAYPLUG_BACKOFF = 0.5  # Seconds before the first retry, doubled on each retry
+PAYPLUG_FLUSH_SIZE = 20  # Payments stored per transaction, see api_payplug.find_recurring_payments
+
+# HTTP connections to Payplug, see network.SessionRequest
+PAYPLUG_POOL_SIZE = 10  # Connections kept alive, and max number of concurrent checkouts waiting for Payplug
+PAYPLUG_CHECKOUT_TIMEOUT = 10  # Seconds a checkout waits for Payplug before giving up
+PAYPLUG_DNS_TTL = 300  # Seconds the address of Payplug is kept by network.DnsCache
+PAYPLUG_LATENCY_BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # Milliseconds, see network.LatencyHistogram
+
+# Bulk updates of api_payplug.checks(), see sweep.sweep()
+SWEEP_BATCH_SIZE = 500  # Rows updated per transaction
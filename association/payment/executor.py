@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent import futures
+
+import payplug
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from .config import PAYPLUG_WORKERS, PAYPLUG_TIMEOUT, PAYPLUG_RETRIES, PAYPLUG_BACKOFF
+
+
+def is_never_sent(error):
+    """
+    Tell if a call to Payplug failed before its request was sent: the connection couldn't be opened (refused, DNS
+    failure, connect timeout), so Payplug can't have taken the payment and the call can be made again.
+    Any other error, like a connection dropped or a read timeout after the request was sent, or an HTTP 5xx,
+    may come with a payment taken by Payplug: it's not retried, but reported to be checked by hand.
+
+    :param error: The exception raised by the call
+    """
+    if not isinstance(error, payplug.exceptions.ClientError):
+        return False
+    cause = error.client_exception
+    if isinstance(cause, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(cause, requests.exceptions.ConnectionError) and cause.args:
+        return isinstance(getattr(cause.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+Outcome = namedtuple("Outcome", ("item", "result", "error"))
+
+
+class PayplugExecutor(object):
+    """
+    Run calls to Payplug in a bounded pool of threads.
+    Each call is retried with an exponential backoff when its request couldn't be sent, and abandoned after a timeout.
+    The calls create payments without idempotency key, so an error after the request was sent is never retried.
+
+    The calls must not write in db: their results are handed back to the calling thread, which stays the only writer.
+    """
+
+    def __init__(self, max_workers=PAYPLUG_WORKERS, timeout=PAYPLUG_TIMEOUT, retries=PAYPLUG_RETRIES,
+                 backoff=PAYPLUG_BACKOFF, retry_if=is_never_sent):
+        """
+        :param max_workers: Max number of concurrent calls
+        :param timeout: Seconds before a call is abandoned, retries included
+        :param retries: Retries of a call on the errors accepted by retry_if
+        :param backoff: Seconds before the first retry, doubled on each retry
+        :param retry_if: Callable taking the exception raised by a call, True if the call can be made again
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_if = retry_if
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func and retry it with an exponential backoff, as long as the timeout allows it.
+
+        :return: The result of func
+        """
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                if not self.retry_if(e) or attempt > self.retries or time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+
+    def map(self, func, items):
+        """
+        Call func on each item in the pool of threads.
+
+        A call still running after the timeout is yielded with a TimeoutError and never retried,
+        because Payplug may have accepted it: it has to be checked by hand.
+
+        :param func: A callable taking an item, which must not write in db
+        :param items: The items to process
+        :return: A generator of Outcome(item, result, error), in the order the calls end
+        """
+        started = {}
+        lock = threading.Lock()
+
+        def run(index, item):
+            with lock:
+                started[index] = time.monotonic()
+            return self.call(func, item)
+
+        pool = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            jobs = {pool.submit(run, index, item): (index, item) for index, item in enumerate(items)}
+            pending = set(jobs)
+            while pending:
+                with lock:
+                    deadlines = [started[jobs[job][0]] + self.timeout for job in pending if jobs[job][0] in started]
+                wait = max(min(deadlines) - time.monotonic(), 0) if deadlines else self.timeout
+                done, pending = futures.wait(pending, timeout=wait, return_when=futures.FIRST_COMPLETED)
+
+                for job in done:
+                    item = jobs[job][1]
+                    error = job.exception()
+                    yield Outcome(item, None if error else job.result(), error)
+
+                now = time.monotonic()
+                with lock:
+                    expired = {job for job in pending if now - started.get(jobs[job][0], now) >= self.timeout}
+                for job in expired:
+                    yield Outcome(jobs[job][1], None, futures.TimeoutError("Payplug call timed out"))
+                pending -= expired
+        finally:
+            pool.shutdown(wait=False)
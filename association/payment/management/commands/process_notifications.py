@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from account.invoices import close_pool
+from payment.api_payplug import process_notifications, notifications_queue_stats
+from payment.network import get_latency_histograms
+
+
+class Command(BaseCommand):
+    help = "Treat the notifications posted by Payplug and queued by notifications_payplug_view"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="Notifications treated per batch")
+        parser.add_argument("--forever", action="store_true", help="Keep waiting for new notifications")
+        parser.add_argument("--sleep", type=float, default=5, help="Seconds between two polls with --forever")
+        parser.add_argument("--stats", action="store_true", help="Only display the depth and the lag of the queue")
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            self.write_stats()
+            return
+
+        while True:
+            while process_notifications(batch_size=options["batch_size"]) == options["batch_size"]:
+                self.write_stats()
+            self.write_stats()
+            if not options["forever"]:
+                break
+            time.sleep(options["sleep"])
+        close_pool()  # Let the invoices of the payments be rendered
+
+    def write_stats(self):
+        stats = notifications_queue_stats()
+        self.stdout.write("depth=%(depth)d lag=%(lag).1fs" % stats)
+        for key, histogram in sorted(get_latency_histograms().items()):  # Calls to Payplug made by this process
+            self.stdout.write("%s %r" % (key, histogram))
@@ -0,0 +1,69 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from payment.models import JobRun
+from payment.scheduler import get_jobs, get_owner, run_job, is_slow
+
+
+class Command(BaseCommand):
+    help = "Run the jobs of settings.SCHEDULER_JOBS on their schedules"
+
+    def add_arguments(self, parser):
+        parser.add_argument("jobs", nargs="*", help="Names of the jobs to run, all by default")
+        parser.add_argument("--once", action="store_true", help="Run the jobs once now, then exit")
+        parser.add_argument("--max-sleep", type=float, default=60, help="Max seconds between two looks at the jobs")
+        parser.add_argument("--history", type=int, metavar="N", help="Only display the last N runs of the jobs")
+
+    def handle(self, *args, **options):
+        try:
+            jobs = get_jobs(options["jobs"])
+        except KeyError as e:
+            raise CommandError("Unknown job %s" % e)
+        if options["history"]:
+            self.write_history(jobs, options["history"])
+            return
+
+        owner = get_owner()
+        if options["once"]:
+            for job in jobs:
+                self.run(job, owner)
+            return
+
+        next_runs = {job.name: job.next_run(timezone.now()) for job in jobs}
+        while True:
+            for job in jobs:
+                if next_runs[job.name] <= timezone.now():
+                    self.run(job, owner)
+                    next_runs[job.name] = job.next_run(timezone.now())
+            wait = (min(next_runs.values()) - timezone.now()).total_seconds()
+            time.sleep(min(max(wait, 0), options["max_sleep"]))
+
+    def run(self, job, owner):
+        # Like around a request: a connection lost while sleeping, or older than CONN_MAX_AGE, is opened again
+        close_old_connections()
+        try:
+            run = run_job(job, owner)
+        finally:
+            close_old_connections()
+        if run is None:
+            self.stderr.write("%s skipped: already running" % job.name)
+            return
+        self.write_run(run)
+        if run.status == JobRun.ERROR:
+            self.stderr.write("%s failed: %s" % (job.name, run.error_message))
+        elif is_slow(run):
+            self.stderr.write("%s is slow: %.1fs" % (job.name, run.duration))
+
+    def write_run(self, run):
+        rows = "-" if run.rows is None else run.rows
+        self.stdout.write("%s %s %s duration=%.3fs rows=%s errors=%d" % (
+            run.name, timezone.localtime(run.started).strftime("%Y-%m-%d %H:%M:%S"), run.status or "running",
+            run.duration or 0, rows, run.errors))
+
+    def write_history(self, jobs, count):
+        for job in jobs:
+            for run in reversed(JobRun.objects.filter(name=job.name).order_by("-started")[:count]):
+                self.write_run(run)
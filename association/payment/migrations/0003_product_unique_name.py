@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2017-11-06 14:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def rename_duplicate_products(apps, schema_editor):
+    """
+    The products of a subscription could share a name before it was unique. The last one keeps the name, the older
+    ones get their id appended to it. They are renamed and not merged, their payments keep pointing to them.
+    """
+    Product = apps.get_model("payment", "Product")
+    duplicates = Product.objects.values("subscription_id", "name").annotate(count=models.Count("id")) \
+                                .filter(count__gt=1)
+    for duplicate in duplicates:
+        products = Product.objects.filter(subscription_id=duplicate["subscription_id"], name=duplicate["name"]) \
+                                  .order_by("-id")
+        for product in products[1:]:
+            suffix = " #%d" % product.pk
+            Product.objects.filter(pk=product.pk).update(name=product.name[:255 - len(suffix)] + suffix)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0002_payplugnotification'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_products, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='product',
+            unique_together=set([('subscription', 'name')]),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2017-11-13 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0004_sweepcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('acquired', models.DateTimeField()),
+                ('owner', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='JobRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(null=True)),
+                ('duration', models.FloatField(null=True)),
+                ('rows', models.IntegerField(null=True)),
+                ('errors', models.IntegerField(default=0)),
+                ('status', models.CharField(default='', max_length=255)),
+                ('error_message', models.TextField(default='')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='jobrun',
+            index=models.Index(fields=['name', 'started'], name='payment_jobrun_name_idx'),
+        ),
+    ]
@@ -25,6 +25,9 @@ class Product(models.Model):
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE, related_name='products')
     # payments = PaymentsUser(models.Model)
 
+    class Meta:
+        unique_together = [("subscription", "name")]  # The product of a payment is found by these names
+
     def __str__(self):
         return self.name
 
@@ -32,3 +35,70 @@ class Product(models.Model):
         self.price = self.ht + (self.tva / 100) * self.ht
         super(Product, self).save(*args, **kwargs)
 
+
+class PayplugNotification(models.Model):
+    """
+    Raw notification posted by Payplug, queued until the process_notifications command treats it.
+    """
+    PENDING = ""
+    DONE = "done"
+    DUPLICATE = "duplicate"
+    ERROR = "error"
+
+    body = models.TextField()
+    reference = models.CharField(max_length=255, default="", db_index=True)  # Payment id generated by Payplug
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, db_index=True)
+    status = models.CharField(max_length=255, default=PENDING)
+    error_message = models.CharField(max_length=255, default="")
+
+    def __str__(self):
+        return "%s %s" % (self.reference, self.status)
+
+
+class SweepCheckpoint(models.Model):
+    """
+    Progress of a sweep.sweep(): the last primary key updated, so an interrupted sweep resumes after it.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    last_pk = models.BigIntegerField(default=0)  # 0 when no sweep is in progress
+    finished = models.DateTimeField(null=True)  # End of the last complete sweep
+
+    def __str__(self):
+        return "%s %d" % (self.name, self.last_pk)
+
+
+class JobRun(models.Model):
+    """
+    A run of a job of payment.scheduler, kept to follow the runtime of the jobs over time.
+    """
+    RUNNING = ""
+    DONE = "done"
+    ERROR = "error"
+
+    name = models.CharField(max_length=255)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True)
+    duration = models.FloatField(null=True)  # Seconds
+    rows = models.IntegerField(null=True)  # Rows touched, when the task reports them
+    errors = models.IntegerField(default=0)  # Errors reported by the task, like the refused renewals
+    status = models.CharField(max_length=255, default=RUNNING)
+    error_message = models.TextField(default="")
+
+    class Meta:
+        indexes = [models.Index(fields=["name", "started"], name="payment_jobrun_name_idx")]
+
+    def __str__(self):
+        return "%s %s %s" % (self.name, self.started, self.status)
+
+
+class JobLock(models.Model):
+    """
+    Held while a job of payment.scheduler runs, so two schedulers never run the same job at once.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    acquired = models.DateTimeField()
+    owner = models.CharField(max_length=255)  # host:pid of the scheduler
+
+    def __str__(self):
+        return "%s %s" % (self.name, self.owner)
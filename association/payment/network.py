@@ -0,0 +1,210 @@
+import bisect
+import json
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import payplug
+import requests
+from payplug import config as payplug_config
+from payplug.network import HttpRequest
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from .config import PAYPLUG_POOL_SIZE, PAYPLUG_TIMEOUT, PAYPLUG_DNS_TTL, PAYPLUG_LATENCY_BUCKETS
+
+
+class DnsCache(object):
+    """
+    Addresses of the hosts, resolved once per ttl instead of once per new connection.
+    """
+
+    def __init__(self, ttl=PAYPLUG_DNS_TTL):
+        self.ttl = ttl
+        self._addresses = {}  # (host, port): (address, expiry)
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        :return: The address of the host, from the cache if resolved less than ttl seconds ago
+        """
+        with self._lock:
+            address, expiry = self._addresses.get((host, port), (None, 0))
+        if expiry < time.monotonic():
+            address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+            with self._lock:
+                self._addresses[(host, port)] = (address, time.monotonic() + self.ttl)
+        return address
+
+    def forget(self, host, port):
+        with self._lock:
+            self._addresses.pop((host, port), None)
+
+
+dns_cache = DnsCache()
+
+
+class DnsCacheMixin(object):
+    """
+    Connection opening its socket to the address given by dns_cache. The host name is kept for TLS.
+    """
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            self._dns_host = dns_cache.resolve(host, self.port)
+        except socket.gaierror as e:  # Like urllib3, so the call is known as never sent
+            raise NewConnectionError(self, "Failed to resolve %r: %s" % (host, e))
+        try:
+            return super(DnsCacheMixin, self)._new_conn()
+        except NewConnectionError:
+            dns_cache.forget(host, self.port)  # The address may have changed
+            raise
+        finally:
+            self._dns_host = host
+
+
+class DnsCacheHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = type("DnsCacheHTTPConnection", (DnsCacheMixin, HTTPConnection), {})
+
+
+class DnsCacheHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = type("DnsCacheHTTPSConnection", (DnsCacheMixin, HTTPSConnection), {})
+
+
+class DnsCacheAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(DnsCacheAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": DnsCacheHTTPConnectionPool,
+                                                   "https": DnsCacheHTTPSConnectionPool}
+
+
+class LatencyHistogram(object):
+    """
+    Distribution of the durations of the calls, in buckets of milliseconds.
+    """
+
+    def __init__(self, bounds=PAYPLUG_LATENCY_BUCKETS):
+        """
+        :param bounds: Upper bounds of the buckets in milliseconds, sorted. The last bucket has no bound.
+        """
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0  # Milliseconds
+
+    def add(self, seconds, error=False):
+        milliseconds = seconds * 1000
+        self.buckets[bisect.bisect_left(self.bounds, milliseconds)] += 1
+        self.count += 1
+        self.errors += error
+        self.total += milliseconds
+
+    @property
+    def mean(self):
+        if self.count:
+            return self.total / self.count
+        return 0.0
+
+    def percentile(self, percent):
+        """
+        :return: The upper bound in milliseconds of the bucket holding the percentile, None for the last bucket
+        """
+        rank = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else None
+        return 0
+
+    def __repr__(self):
+        return "<LatencyHistogram count=%d errors=%d mean=%.1fms p50<=%s p99<=%s>" % (
+            self.count, self.errors, self.mean, self.percentile(50), self.percentile(99))
+
+
+_histograms = {}  # "VERB resource": LatencyHistogram
+_histograms_lock = threading.Lock()
+
+
+def record_latency(key, seconds, error=False):
+    with _histograms_lock:
+        if key not in _histograms:
+            _histograms[key] = LatencyHistogram()
+        _histograms[key].add(seconds, error)
+
+
+def get_latency_histograms():
+    """
+    :return: The histograms of the calls to Payplug made by this process, by "VERB resource" like "POST payments"
+    """
+    with _histograms_lock:
+        return dict(_histograms)
+
+
+def reset_latency_histograms():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+# Session shared by the calls to Payplug, created on first use
+_session = None
+
+
+def get_session():
+    """
+    The requests session sending the calls to Payplug: its connections are kept alive and reused by the next calls.
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = DnsCacheAdapter(pool_connections=1, pool_maxsize=PAYPLUG_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+
+class SessionRequest(HttpRequest):
+    """
+    Request handler of the Payplug client, like payplug.network.RequestsRequest but through the shared session,
+    with a timeout, and recording the latency of each call.
+    """
+    DEPENDENCY = "requests"
+    timeout = PAYPLUG_TIMEOUT  # Seconds
+
+    def do_request(self, http_verb, url, headers, data=None):
+        if data:
+            data = json.dumps(data)
+        path = urlparse(url).path.split("/")  # ["", "v1", "payments", ...]
+        key = "%s %s" % (http_verb, path[2] if len(path) > 2 else "")
+        start = time.monotonic()
+        try:
+            response = get_session().request(http_verb, url, headers=headers, data=data,
+                                             verify=payplug_config.CACERT_PATH, timeout=self.timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.TooManyRedirects) as exception:
+            record_latency(key, time.monotonic() - start, error=True)
+            self._raise_unrecoverable_error_payplug(exception)
+        except requests.exceptions.RequestException as exception:
+            record_latency(key, time.monotonic() - start, error=True)
+            self._raise_unrecoverable_error_client(exception)
+        record_latency(key, time.monotonic() - start, error=response.status_code >= 500)
+
+        return response.content, response.status_code, response.headers
+
+    @staticmethod
+    def get_useragent_string():
+        return "python-" + SessionRequest.DEPENDENCY + "/" + requests.__version__
+
+
+def install():
+    """
+    Make SessionRequest the request handler of the Payplug client: payplug.Payment.create(),
+    payplug.notifications.treat() and every other call of the library go through the shared session.
+    """
+    if payplug.network.available_clients[:1] != [SessionRequest]:
+        payplug.network.available_clients.insert(0, SessionRequest)
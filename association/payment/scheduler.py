@@ -0,0 +1,223 @@
+import datetime
+import os
+import random
+import socket
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Avg
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import JobRun, JobLock
+
+# Bounds of the fields of a schedule: minute, hour, day of month, month, day of week (0 or 7 for sunday)
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_cron_field(text, low, high):
+    """
+    Parse a field of a crontab: *, a number, a range a-b, a step */n or a-b/n, or a list of them separated by commas.
+
+    :return: The set of the values matched by the field
+    """
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError("Invalid field %r, values go from %d to %d" % (text, low, high))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+    """
+    Times given like in a crontab: "minute hour day-of-month month day-of-week", in the TIME_ZONE of the site.
+    When both days are given, like in cron, a day matching one of them is enough.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError("Invalid schedule %r, 5 fields are expected" % expression)
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS))
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+
+    def day_matches(self, day):
+        in_month = day.day in self.days
+        in_week = (day.weekday() + 1) % 7 in self.weekdays  # 0 for sunday, like cron
+        if self.any_day:
+            return in_week
+        if self.any_weekday:
+            return in_month
+        return in_month or in_week
+
+    def next_after(self, moment):
+        """
+        :param moment: An aware datetime
+        :return: The first aware datetime matching the schedule, strictly after moment
+        """
+        local = timezone.localtime(moment).replace(tzinfo=None, second=0, microsecond=0)
+        local += datetime.timedelta(minutes=1)
+        limit = local + datetime.timedelta(days=4 * 366)  # A 29th of february comes in at most 4 years
+        while local < limit:
+            if local.month not in self.months:
+                local = (local.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=31)).replace(day=1)
+            elif not self.day_matches(local):
+                local = local.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif local.hour not in self.hours:
+                local = local.replace(minute=0) + datetime.timedelta(hours=1)
+            elif local.minute not in self.minutes:
+                local += datetime.timedelta(minutes=1)
+            else:
+                return timezone.make_aware(local, is_dst=False)  # Moved by an hour when the clock changes
+        raise ValueError("The schedule %r never matches" % self.expression)
+
+    def __repr__(self):
+        return "<CronSchedule %s>" % self.expression
+
+
+class Job(object):
+    """
+    A task run on a schedule by the run_scheduler command
+    """
+
+    def __init__(self, name, task, schedule, jitter=0, args=(), kwargs=None):
+        """
+        :param name: Name of the job, in its runs and its lock
+        :param task: The callable, or its dotted path
+        :param schedule: Times of the runs, see CronSchedule
+        :param jitter: Max seconds randomly added to each time of the schedule
+        :param args: Positional arguments of the task
+        :param kwargs: Keyword arguments of the task
+        """
+        self.name = name
+        self.task = import_string(task) if isinstance(task, str) else task
+        self.schedule = CronSchedule(schedule)
+        self.jitter = jitter
+        self.args = args
+        self.kwargs = kwargs or {}
+
+    def next_run(self, after):
+        """
+        :param after: An aware datetime
+        :return: The time of the next run of the job after it, jitter included
+        """
+        return self.schedule.next_after(after) + datetime.timedelta(seconds=random.uniform(0, self.jitter))
+
+    def __repr__(self):
+        return "<Job %s %s>" % (self.name, self.schedule.expression)
+
+
+def get_jobs(names=None):
+    """
+    :param names: Names of the jobs wanted, all by default
+    :return: The Jobs of settings.SCHEDULER_JOBS
+    :raise KeyError: For a name which isn't in settings.SCHEDULER_JOBS
+    """
+    names = names or sorted(settings.SCHEDULER_JOBS)
+    return [Job(name, **settings.SCHEDULER_JOBS[name]) for name in names]
+
+
+def get_owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def acquire_lock(name, owner, timeout=None):
+    """
+    Take the lock of a job. A lock older than timeout is taken over, its holder is considered dead.
+
+    :param timeout: Seconds, SCHEDULER_LOCK_TIMEOUT by default
+    :return: True if the lock is taken
+    """
+    timeout = timeout or settings.SCHEDULER_LOCK_TIMEOUT
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            JobLock.objects.create(name=name, acquired=now, owner=owner)
+        return True
+    except IntegrityError:
+        stale = now - datetime.timedelta(seconds=timeout)
+        return JobLock.objects.filter(name=name, acquired__lt=stale).update(acquired=now, owner=owner) == 1
+
+
+def release_lock(name, owner):
+    JobLock.objects.filter(name=name, owner=owner).delete()
+
+
+def summarize(result):
+    """
+    Rows touched and errors reported by the result of a task: a number of rows, a report with rows and errors
+    attributes like RenewalReport, or a list of them.
+
+    :return: (rows or None, errors)
+    """
+    if isinstance(result, (list, tuple)):
+        summaries = [summarize(item) for item in result]
+        rows = [rows for rows, _ in summaries if rows is not None]
+        return sum(rows) if rows else None, sum(errors for _, errors in summaries)
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result, 0
+    return getattr(result, "rows", None), len(getattr(result, "errors", None) or [])
+
+
+def run_job(job, owner=None):
+    """
+    Run a job now and store its JobRun. An error of the task is stored in the run, and not raised.
+
+    :param owner: Holder of the lock of the job, the host and pid of the process by default
+    :return: The JobRun, or None if the job is already run by another scheduler
+    """
+    owner = owner or get_owner()
+    if not acquire_lock(job.name, owner):
+        return None
+    run = JobRun.objects.create(name=job.name, started=timezone.now())
+    start = time.monotonic()
+    try:
+        result = job.task(*job.args, **job.kwargs)
+    except Exception as e:
+        run.status = JobRun.ERROR
+        run.error_message = "%s: %s" % (type(e).__name__, e)
+    else:
+        run.status = JobRun.DONE
+        run.rows, run.errors = summarize(result)
+    finally:
+        run.duration = time.monotonic() - start
+        run.finished = timezone.now()
+        run.save()
+        release_lock(job.name, owner)
+    return run
+
+
+def average_duration(name, before, count=10):
+    """
+    :param before: The JobRun compared, only the previous runs are taken
+    :param count: Number of successful runs taken
+    :return: The average duration of the last successful runs of the job, None if there isn't any
+    """
+    pks = JobRun.objects.filter(name=name, status=JobRun.DONE, pk__lt=before.pk) \
+                        .order_by("-pk").values_list("pk", flat=True)[:count]
+    return JobRun.objects.filter(pk__in=list(pks)).aggregate(Avg("duration"))["duration__avg"]
+
+
+def is_slow(run):
+    """
+    :return: True if the run lasted more than SCHEDULER_SLOW_FACTOR times the average of the previous ones
+    """
+    average = average_duration(run.name, before=run)
+    return average is not None and run.duration > settings.SCHEDULER_SLOW_FACTOR * average
@@ -0,0 +1,77 @@
+import time
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .config import SWEEP_BATCH_SIZE
+from .models import SweepCheckpoint
+
+
+class SweepReport(object):
+    """
+    Summary of a run of sweep()
+    """
+
+    def __init__(self, name, rows=0, chunks=0, seconds=0.0, lock_wait=0.0, resumed_from=0):
+        self.name = name
+        self.rows = rows  # Rows updated
+        self.chunks = chunks  # Transactions committed
+        self.seconds = seconds
+        self.lock_wait = lock_wait  # Seconds spent waiting for the write locks
+        self.resumed_from = resumed_from  # Primary key after which the sweep started, 0 if not resumed
+
+    @property
+    def rate(self):
+        """
+        Rows updated per second
+        """
+        if self.seconds:
+            return self.rows / self.seconds
+        return 0.0
+
+    def __repr__(self):
+        return "<SweepReport %s rows=%d chunks=%d seconds=%.3f rate=%.1f/s lock_wait=%.3f>" % (
+            self.name, self.rows, self.chunks, self.seconds, self.rate, self.lock_wait)
+
+
+def sweep(name, queryset, values, batch_size=None):
+    """
+    Run queryset.update(**values) by chunks of rows in primary key order, each one in its own short transaction,
+    so the write locks are only held for a chunk and never for the whole table.
+    The conditions of the queryset are checked again when a chunk is written, so a row changed in the meantime
+    is left untouched.
+
+    The last primary key of each chunk is stored with it in a SweepCheckpoint: an interrupted sweep resumes after it,
+    a complete one starts again from the beginning.
+    The write of the checkpoint is the first of the transaction, so its duration is the wait for the lock of SQLite.
+    On the backends with row locks, the rows of the chunk are locked beforehand and this wait is counted too.
+
+    :param name: Name of the checkpoint
+    :param queryset: The rows to update
+    :param values: Dict of the new values of the fields
+    :param batch_size: Rows per chunk, SWEEP_BATCH_SIZE by default
+    :return: A SweepReport of the run
+    """
+    start = time.monotonic()
+    batch_size = batch_size or SWEEP_BATCH_SIZE
+    checkpoint, _ = SweepCheckpoint.objects.get_or_create(name=name)
+    report = SweepReport(name, resumed_from=checkpoint.last_pk)
+    last_pk = checkpoint.last_pk
+
+    while True:
+        pks = list(queryset.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        with transaction.atomic():
+            waited = time.monotonic()
+            SweepCheckpoint.objects.filter(pk=checkpoint.pk).update(last_pk=last_pk)
+            if connection.features.has_select_for_update:
+                pks = list(queryset.select_for_update().filter(pk__in=pks).values_list("pk", flat=True))
+            report.lock_wait += time.monotonic() - waited
+            report.rows += queryset.filter(pk__in=pks).update(**values)
+        report.chunks += 1
+
+    SweepCheckpoint.objects.filter(pk=checkpoint.pk).update(last_pk=0, finished=timezone.now())
+    report.seconds = time.monotonic() - start
+    return report
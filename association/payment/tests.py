@@ -1,16 +1,43 @@
+import asyncio
 import datetime
+import json
+import socket
+import socketserver
+import threading
+import time
 import uuid
 from collections import namedtuple
+from concurrent import futures
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from io import StringIO
 from unittest.mock import patch
+
+import payplug
+import requests
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection, IntegrityError
+from django.db.backends.utils import CursorWrapper
+from django.db.models.query import QuerySet
 from django.test.client import RequestFactory
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from django.utils import timezone
 
+from .catalogue import get_catalogue, find_product, find_product_by_token
+from .async_payplug import AsyncPayplugClient, create_classic_payment_async, run_coroutine
+from .executor import PayplugExecutor, is_never_sent
+from .network import SessionRequest, LatencyHistogram, DnsCache, get_latency_histograms, reset_latency_histograms
 from .views import notifications_payplug_view
-from .models import Subscription, Product
+from .models import Subscription, Product, PayplugNotification, SweepCheckpoint, JobRun, JobLock
+from .scheduler import CronSchedule, Job, get_jobs, run_job, summarize, is_slow, acquire_lock
+from .sweep import sweep, SweepReport
 from .api_payplug import (create_classic_payment, find_recurring_payments, make_recurring_payment, checks,
-                          PAID_PAYMENT_STATUS)
-from account.models import User, SaveCardUser
+                          load_due_renewals, process_notifications, notifications_queue_stats, update_payment,
+                          PAID_PAYMENT_STATUS, RenewalReport)
+from account.models import User, SaveCardUser, PaymentsUser
 
 Token = uuid.uuid4()  # Ensure transactions between us and payplug
 
@@ -130,6 +157,91 @@ class TestSubscriptionView(TestCase):
         self.assertContains(response, "<b>rien</b>")
 
 
+class TestCatalogue(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User(username="guillaume", email="te@test.com", accreditation=1)
+        cls.user.set_password('passpass')
+        cls.user.save()
+
+        for name in ("gold", "silver", "bronze"):
+            subscription = Subscription.objects.create(name=name, description="test")
+            for i in range(3):
+                Product.objects.create(name="%s%d" % (name, i), description="rien", price=120, tva=20, ht=100,
+                                       recurrent=False, duration=50, subscription=subscription)
+        cls.path = reverse(u"subscriptions")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_queries(self):
+        with self.assertNumQueries(2):
+            catalogue = get_catalogue()
+            self.assertEqual([len(subscription.products.all()) for subscription in catalogue], [3, 3, 3])
+        with self.assertNumQueries(0):
+            catalogue = get_catalogue()
+            self.assertEqual([product.name for product in catalogue[0].products.all()], ["gold0", "gold1", "gold2"])
+
+    def test_invalidated(self):
+        get_catalogue()
+        product = Product.objects.get(name="gold0")
+        product.name = "platinum"
+        product.save()
+        self.assertEqual([product.name for product in get_catalogue()[0].products.all()],
+                         ["platinum", "gold1", "gold2"])
+
+        Subscription.objects.get(name="silver").delete()
+        self.assertEqual([subscription.name for subscription in get_catalogue()], ["gold", "bronze"])
+
+    def test_fragment(self):
+        self.client.login(username="guillaume", password="passpass")
+        response = self.client.get(self.path)
+        self.assertContains(response, "gold0")
+
+        Product.objects.filter(name="gold0").update(name="platinum")  # No signal: still in the cache
+        response = self.client.get(self.path)
+        self.assertContains(response, "gold0")
+
+        Product.objects.get(name="platinum").save()
+        response = self.client.get(self.path)
+        self.assertContains(response, "platinum")
+        self.assertNotContains(response, "gold0")
+
+    def test_find_product(self):
+        get_catalogue()
+        with self.assertNumQueries(0):
+            product = find_product("silver", "silver1")
+            self.assertEqual((product.subscription.name, product.name), ("silver", "silver1"))
+            self.assertEqual(find_product_by_token(product.token), product)
+            self.assertEqual(find_product_by_token(product.token.hex), product)
+        with self.assertNumQueries(2):  # Looked for in the db
+            self.assertIsNone(find_product("gold", "silver1"))
+            self.assertIsNone(find_product_by_token(uuid.uuid4()))
+        with self.assertNumQueries(0):
+            self.assertIsNone(find_product_by_token("not a token"))
+
+    def test_find_product_refreshed(self):
+        find_product("gold", "gold0")
+        Product.objects.create(name="gold3", description="rien", price=120, tva=20, ht=100, recurrent=False,
+                               duration=50, subscription=Subscription.objects.get(name="gold"))
+        self.assertEqual(find_product("gold", "gold3").name, "gold3")
+
+        Subscription.objects.get(name="gold").delete()
+        self.assertIsNone(find_product("gold", "gold0"))
+
+    def test_find_product_missing_from_cache(self):
+        find_product("gold", "gold0")
+        Product.objects.bulk_create([Product(name="gold3", description="rien", price=120, tva=20, ht=100,
+                                             recurrent=False, duration=50,
+                                             subscription=Subscription.objects.get(name="gold"))])  # No signal
+        with self.assertNumQueries(1):
+            product = find_product("gold", "gold3")
+            self.assertEqual(product.subscription.name, "gold")
+        self.assertEqual(find_product_by_token(product.token), product)
+        with self.assertNumQueries(0):  # The index was loaded again
+            self.assertEqual(find_product("gold", "gold3"), product)
+
+
 class TestPaymentView(TestCase):
     """
         Tests of view.py --> payment_view()
@@ -165,6 +277,18 @@ class TestPaymentView(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertIn("https://secure.payplug.com/pay/test/", response.url)
 
+    @patch("payment.views.create_classic_payment")
+    def test_product_lookup_queries(self, payment_mock):
+        payment_mock.return_value.hosted_payment.payment_url = "https://secure.payplug.com/pay/test/a"
+        self.client.login(username="guillaume", password="passpass")
+        self.client.get(self.path)  # Fill the cache
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.path)
+        self.assertFalse([query for query in queries if "payment_product" in query["sql"]])
+        self.assertEqual(payment_mock.call_args[1]["product"], self.product)
+        self.assertEqual(payment_mock.call_args[1]["subscription"], self.subscription)
+
     # Errors tests
 
     def test_error_product(self):
@@ -186,6 +310,211 @@ class TestPaymentView(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+class FakePayplugHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        self.server.clients.add(self.client_address)
+        self.server.charges.append(data)
+        time.sleep(self.server.delay)
+        if self.server.drop:  # The payment is taken, but the answer is lost
+            self.close_connection = True
+            return
+        payment_id = "pay_%s" % uuid.uuid4().hex
+        body = json.dumps({
+            "id": payment_id,
+            "object": "payment",
+            "is_paid": False,
+            "amount": data["amount"],
+            "metadata": data.get("metadata"),
+            "hosted_payment": {"payment_url": "https://secure.payplug.com/pay/test/%s" % payment_id},
+        }).encode()
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakePayplugServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Local server answering the payment creations like Payplug
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, drop=False):
+        super(FakePayplugServer, self).__init__(("127.0.0.1", 0), FakePayplugHandler)
+        self.delay = delay
+        self.drop = drop  # Close the connection instead of answering
+        self.clients = set()  # (host, port) of the connections
+        self.charges = []  # Data of the payments created
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        pass  # The clients which timed out closed the connection
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        self.routes_patch = patch.object(payplug.routes, "API_BASE_URL", self.url)
+        self.routes_patch.start()
+        return self
+
+    def __exit__(self, *args):
+        self.routes_patch.stop()
+        self.shutdown()
+        self.server_close()
+
+
+class BarrierPayplugClient(AsyncPayplugClient):
+    """
+    Client whose calls all wait for each other: they fail unless they run at the same time
+    """
+
+    def __init__(self, parties):
+        super(BarrierPayplugClient, self).__init__(timeout=5, executor=futures.ThreadPoolExecutor(parties))
+        self.barrier = threading.Barrier(parties, timeout=2)
+
+    def _create_payment(self, data):
+        self.barrier.wait()  # BrokenBarrierError if the calls are made one after the other
+        return payplug.resources.Payment(id="pay_%s" % uuid.uuid4().hex, object="payment", is_paid=False)
+
+
+class TestAsyncPayplug(TransactionTestCase):
+    """
+    The queries of the coroutines run in the db thread of run_db(), so the data must be committed
+    """
+
+    def setUp(self):
+        self.user = User(username="guillaume", email="te@test.com", accreditation=1)
+        self.user.set_password('passpass')
+        self.user.save()
+
+        self.subscription = Subscription.objects.create(name="gold", description="test")
+        self.product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                              recurrent=False, duration=50, subscription=self.subscription)
+
+    def create_payment(self, client=None):
+        return create_classic_payment_async(self.user, self.subscription, self.product, client=client)
+
+    def test_create_payment(self):
+        with FakePayplugServer():
+            response = run_coroutine(self.create_payment())
+
+        payment = PaymentsUser.objects.get()
+        self.assertEqual(response.hosted_payment.payment_url, "https://secure.payplug.com/pay/test/%s" %
+                         payment.reference)
+        self.assertEqual((payment.user, payment.product, payment.subscription),
+                         (self.user, self.product, self.subscription))
+
+    def test_queries_out_of_loop(self):
+        loop_thread = threading.get_ident()
+        threads = set()
+
+        def execute(*args, **kwargs):
+            threads.add(threading.get_ident())
+            return original(*args, **kwargs)
+
+        original = CursorWrapper.execute
+        with FakePayplugServer():
+            with patch.object(CursorWrapper, "execute", autospec=True, side_effect=execute):
+                run_coroutine(self.create_payment())
+
+        self.assertEqual(PaymentsUser.objects.count(), 1)
+        self.assertTrue(threads)
+        self.assertNotIn(loop_thread, threads)
+
+    def test_timeout(self):
+        with FakePayplugServer(delay=0.5):
+            with self.assertRaises(asyncio.TimeoutError):
+                run_coroutine(AsyncPayplugClient(timeout=0.1).create_payment(amount=100))
+
+    def test_concurrent(self):
+        client = BarrierPayplugClient(5)
+
+        async def payments():
+            return await asyncio.gather(*[self.create_payment(client) for _ in range(5)])
+
+        responses = run_coroutine(payments())
+
+        self.assertEqual(len({response.id for response in responses}), 5)
+        self.assertEqual(PaymentsUser.objects.count(), 5)
+
+    def test_keep_alive(self):
+        client = AsyncPayplugClient(timeout=5)
+        with FakePayplugServer() as server:
+            for i in range(3):
+                run_coroutine(client.create_payment(amount=100))
+        self.assertEqual(len(server.clients), 1)
+
+
+class TestPayplugNetwork(TestCase):
+    def setUp(self):
+        reset_latency_histograms()
+
+    def test_default_handler(self):
+        self.assertIs(payplug.network.HttpClient()._request_handler, SessionRequest)
+
+    def test_keep_alive(self):
+        with FakePayplugServer() as server:
+            for i in range(3):
+                response, status = payplug.network.HttpClient().post(
+                    payplug.routes.url(payplug.routes.PAYMENT_RESOURCE), {"amount": 100})
+                self.assertEqual(status, 201)
+        self.assertEqual(len(server.clients), 1)
+
+        histogram = get_latency_histograms()["POST payments"]
+        self.assertEqual((histogram.count, histogram.errors), (3, 0))
+
+    def test_error_recorded(self):
+        with FakePayplugServer():
+            url = payplug.routes.url(payplug.routes.PAYMENT_RESOURCE)
+        with self.assertRaises(payplug.exceptions.ClientError):  # The server is closed
+            payplug.network.HttpClient().post(url, {"amount": 100})
+        self.assertEqual(get_latency_histograms()["POST payments"].errors, 1)
+
+    def test_histogram(self):
+        histogram = LatencyHistogram(bounds=(10, 100, 1000))
+        for seconds in (0.005, 0.005, 0.05, 0.5, 5):
+            histogram.add(seconds)
+
+        self.assertEqual(histogram.buckets, [2, 1, 1, 1])
+        self.assertEqual(histogram.percentile(50), 100)
+        self.assertEqual(histogram.percentile(10), 10)
+        self.assertIsNone(histogram.percentile(99))
+        self.assertAlmostEqual(histogram.mean, 1112, places=0)
+
+    @patch("payment.network.socket.getaddrinfo", return_value=[(None, None, None, "", ("10.0.0.1", 443))])
+    def test_dns_cache(self, getaddrinfo_mock):
+        dns = DnsCache(ttl=60)
+        self.assertEqual(dns.resolve("api.payplug.com", 443), "10.0.0.1")
+        self.assertEqual(dns.resolve("api.payplug.com", 443), "10.0.0.1")
+        self.assertEqual(getaddrinfo_mock.call_count, 1)
+
+        dns.forget("api.payplug.com", 443)
+        dns.resolve("api.payplug.com", 443)
+        with patch("payment.network.time.monotonic", return_value=time.monotonic() + 61):
+            dns.resolve("api.payplug.com", 443)
+        self.assertEqual(getaddrinfo_mock.call_count, 3)
+
+    @patch("payment.network.dns_cache.resolve", side_effect=socket.gaierror("Name or service not known"))
+    def test_dns_failure_never_sent(self, resolve_mock):
+        url = payplug.routes.url(payplug.routes.PAYMENT_RESOURCE).replace("api.payplug.com", "payplug.test")
+        with self.assertRaises(payplug.exceptions.ClientError) as error:
+            payplug.network.HttpClient().post(url, {"amount": 100})
+        self.assertTrue(is_never_sent(error.exception))
+
+    def test_dns_cache_used(self):
+        with FakePayplugServer() as server, \
+                patch("payment.network.dns_cache.resolve", return_value="127.0.0.1") as resolve_mock:
+            url = payplug.routes.url(payplug.routes.PAYMENT_RESOURCE).replace("127.0.0.1", "payplug.test")
+            payplug.network.HttpClient().post(url, {"amount": 100})
+        resolve_mock.assert_called_once_with("payplug.test", server.server_address[1])
+
+
 class TestReturnUrl(TestCase):
     """
          Tests of view.py --> notifications_payplug_view()
@@ -220,6 +549,7 @@ class TestReturnUrl(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)  # emulate the request
         notifications_payplug_view(request)
+        process_notifications()
 
         self.user.refresh_from_db()
         payment.refresh_from_db()
@@ -246,6 +576,7 @@ class TestReturnUrl(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         self.user.refresh_from_db()
         payment.refresh_from_db()
@@ -270,6 +601,7 @@ class TestReturnUrl(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         self.user.refresh_from_db()
         payment.refresh_from_db()
@@ -292,6 +624,7 @@ class TestReturnUrl(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         self.user.refresh_from_db()
         payment.refresh_from_db()
@@ -322,6 +655,7 @@ class TestReturnUrl(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         self.user.refresh_from_db()
         payment.refresh_from_db()
@@ -337,7 +671,196 @@ class TestReturnUrl(TestCase):
     def test_error_payplug(self):
         request = self.factory.post(self.path)  # emulate the request
         response = notifications_payplug_view(request)
-        self.assertEqual(response.content, b'400')
+        self.assertEqual(response.content, b'200')
+
+        process_notifications()
+        notification = PayplugNotification.objects.get()
+        self.assertEqual(notification.status, PayplugNotification.ERROR)
+        self.assertIsNotNone(notification.processed)
+
+
+class TestUpdatePayment(TestCase):
+    """
+         Tests of api_payplug.py --> update_payment()
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="guillaume", email="test@test.com", password="passpass",
+                                       accreditation=1)
+        subscription = Subscription.objects.create(name="gold", description="test")
+        product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                         recurrent=True, duration=50, subscription=subscription)
+        cls.payment = PaymentsUser.objects.create(reference="pay_a", subscribed_until=datetime.date.today(),
+                                                  price=120, tva=20, subscription=subscription, product=product,
+                                                  user=cls.user, token=Token)
+
+    def test_duplicate(self):
+        response = MockResponse({"id": "pay_a", "save_card": True})
+        update_payment(response)
+
+        with CaptureQueriesContext(connection) as queries:
+            payment = update_payment(response)
+        writes = [query for query in queries if not query["sql"].startswith(("SELECT", "SAVEPOINT", "RELEASE"))]
+
+        self.assertEqual(payment.status, PAID_PAYMENT_STATUS)
+        self.assertEqual(writes, [])
+        self.assertEqual(self.user.card.count(), 1)
+
+    def test_card_stored_once(self):
+        SaveCardUser.objects.create(first_name="g", last_name="t", card_id="card_3QPUTg6VeQhdSa75ke4Wsi",
+                                    card_exp_date=datetime.date.today(), user=self.user)
+        update_payment(MockResponse({"id": "pay_a", "save_card": True}))
+
+        self.assertEqual(SaveCardUser.objects.count(), 1)
+
+    @patch("payment.api_payplug.schedule_invoice")
+    def test_schedule_invoice(self, schedule_mock):
+        update_payment(MockResponse({"id": "pay_a"}))
+        update_payment(MockResponse({"id": "pay_a"}))
+
+        self.assertEqual(schedule_mock.call_count, 1)
+        self.assertEqual(schedule_mock.call_args[0][0].reference, "pay_a")
+
+    @patch("payment.api_payplug.schedule_invoice")
+    def test_no_invoice_on_failure(self, schedule_mock):
+        Failure = namedtuple('Failure', ('code', 'message'))
+        update_payment(MockResponse({"id": "pay_a", "is_paid": False, "failure": Failure("aborted", "aborted")}))
+
+        self.assertFalse(schedule_mock.called)
+
+    def test_scoped_writes(self):
+        with CaptureQueriesContext(connection) as queries:
+            update_payment(MockResponse({"id": "pay_a"}))
+        updates = [query["sql"] for query in queries if query["sql"].startswith("UPDATE")]
+
+        self.assertEqual(len(updates), 3)
+        self.assertNotIn('"username"', "".join(updates))
+        self.assertNotIn('"price"', "".join(updates))
+
+    def test_extend_membership(self):
+        update_payment(MockResponse({"id": "pay_a"}))
+        self.user.refresh_from_db()
+
+        self.assertEqual(self.user.active_until, self.payment.subscribed_until)
+        self.assertEqual(self.user.current_product_id, self.payment.product_id)
+        self.assertEqual(self.user.effective_accreditation, 2)
+
+    def test_extend_membership_keeps_longest(self):
+        later = datetime.date.today() + datetime.timedelta(30)
+        User.objects.filter(pk=self.user.pk).update(active_until=later)
+        update_payment(MockResponse({"id": "pay_a"}))
+        self.user.refresh_from_db()
+
+        self.assertEqual(self.user.active_until, later)
+
+
+class TestNotificationsQueue(TestCase):
+    """
+         Tests of api_payplug.py --> enqueue_notification() and process_notifications()
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="guillaume", email="test@test.com", password="passpass",
+                                       accreditation=1)
+        subscription = Subscription.objects.create(name="gold", description="test")
+        product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                         recurrent=False, duration=50, subscription=subscription)
+        cls.payment = PaymentsUser.objects.create(reference="pay_a", subscribed_until=datetime.date.today(),
+                                                  price=120, tva=20, subscription=subscription, product=product,
+                                                  user=cls.user, token=Token)
+        cls.path = reverse(u"notifications")
+        cls.body = b'{"id": "pay_a", "object": "payment"}'
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_enqueue(self):
+        response = notifications_payplug_view(self.factory.post(self.path, self.body,
+                                                                content_type="application/json"))
+        notification = PayplugNotification.objects.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(notification.reference, "pay_a")
+        self.assertIsNone(notification.processed)
+        self.assertEqual(notifications_queue_stats()["depth"], 1)
+
+    @patch('payplug.notifications.treat')
+    def test_process_duplicates(self, treat_mock):
+        treat_mock.return_value = MockResponse({"id": "pay_a"})
+        for _ in range(3):
+            notifications_payplug_view(self.factory.post(self.path, self.body, content_type="application/json"))
+
+        self.assertEqual(process_notifications(), 3)
+        self.payment.refresh_from_db()
+        statuses = list(PayplugNotification.objects.order_by("id").values_list("status", flat=True))
+
+        self.assertEqual(treat_mock.call_count, 1)
+        self.assertEqual(self.payment.status, PAID_PAYMENT_STATUS)
+        self.assertEqual(statuses, [PayplugNotification.DONE] + [PayplugNotification.DUPLICATE] * 2)
+        self.assertEqual(notifications_queue_stats(), {"depth": 0, "lag": 0.0})
+
+    @patch('payplug.notifications.treat')
+    def test_process_already_paid(self, treat_mock):
+        self.payment.status = PAID_PAYMENT_STATUS
+        self.payment.save()
+        notifications_payplug_view(self.factory.post(self.path, self.body, content_type="application/json"))
+
+        process_notifications()
+
+        self.assertFalse(treat_mock.called)
+        self.assertEqual(PayplugNotification.objects.get().status, PayplugNotification.DUPLICATE)
+
+    @patch('payplug.notifications.treat')
+    def test_process_batch_size(self, treat_mock):
+        treat_mock.return_value = MockResponse({"id": "pay_a"})
+        for _ in range(3):
+            notifications_payplug_view(self.factory.post(self.path, self.body, content_type="application/json"))
+
+        self.assertEqual(process_notifications(batch_size=2), 2)
+        self.assertEqual(notifications_queue_stats()["depth"], 1)
+
+    @patch('payplug.notifications.treat')
+    def test_process_unknown_payment(self, treat_mock):
+        treat_mock.return_value = MockResponse({"id": "pay_unknown"})
+        notifications_payplug_view(self.factory.post(self.path, b"{}", content_type="application/json"))
+
+        process_notifications()
+        notification = PayplugNotification.objects.get()
+
+        self.assertEqual(notification.status, PayplugNotification.ERROR)
+        self.assertEqual(notification.reference, "pay_unknown")
+
+    @patch('payplug.notifications.treat')
+    def test_process_error(self, treat_mock):
+        treat_mock.side_effect = [ValueError("Invalid body"),
+                                  MockResponse({"id": "pay_a", "metadata": None}),  # Not created by the site
+                                  MockResponse({"id": "pay_a"})]
+        for _ in range(3):
+            notifications_payplug_view(self.factory.post(self.path, self.body, content_type="application/json"))
+
+        self.assertEqual(process_notifications(), 3)
+        self.payment.refresh_from_db()
+        notifications = list(PayplugNotification.objects.order_by("id"))
+
+        self.assertEqual([notification.status for notification in notifications],
+                         [PayplugNotification.ERROR, PayplugNotification.ERROR, PayplugNotification.DONE])
+        self.assertEqual(notifications[0].error_message, "ValueError: Invalid body")
+        self.assertTrue(notifications[1].error_message.startswith("TypeError: "))
+        self.assertEqual(self.payment.status, PAID_PAYMENT_STATUS)
+        self.assertEqual(notifications_queue_stats()["depth"], 0)
+
+    @patch('payplug.notifications.treat')
+    def test_command(self, treat_mock):
+        treat_mock.return_value = MockResponse({"id": "pay_a"})
+        notifications_payplug_view(self.factory.post(self.path, self.body, content_type="application/json"))
+        out = StringIO()
+
+        call_command("process_notifications", stdout=out)
+
+        self.assertIn("depth=0", out.getvalue())
+        self.assertEqual(PayplugNotification.objects.get().status, PayplugNotification.DONE)
 
 
 class TestResponseView(TestCase):
@@ -373,6 +896,7 @@ class TestResponseView(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         self.user.refresh_from_db()
         payment.refresh_from_db()
@@ -397,6 +921,7 @@ class TestResponseView(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         self.user.refresh_from_db()
         payment.refresh_from_db()
@@ -451,6 +976,7 @@ class TestRecurringPayments(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         payment.refresh_from_db()
         self._payment()
@@ -469,6 +995,7 @@ class TestRecurringPayments(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         payment.refresh_from_db()
         self._payment()
@@ -487,6 +1014,7 @@ class TestRecurringPayments(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         payment.refresh_from_db()
         data = {
@@ -514,6 +1042,7 @@ class TestRecurringPayments(TestCase):
         treat_mock.return_value = obj
         request = self.factory.post(self.path)
         notifications_payplug_view(request)
+        process_notifications()
 
         payment.refresh_from_db()
         payment.subscribed_until = datetime.date.today()
@@ -525,6 +1054,244 @@ class TestRecurringPayments(TestCase):
         self.assertNotEqual(new_payment.id, payment.id)
 
 
+class TestBatchRecurringPayments(TestCase):
+    """
+       Tests of api_payplug.py --> load_due_renewals() and find_recurring_payments()
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.subscription = Subscription.objects.create(name="gold", description="test")
+        cls.product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
+                                             recurrent=True, duration=50, subscription=cls.subscription)
+        cls.users = [cls.create_member(name) for name in ("a", "b", "c")]
+
+    @classmethod
+    def create_member(cls, name, card=True):
+        today = datetime.date.today()
+        user = User.objects.create(username=name, email="%s@test.com" % name, password="passpass", accreditation=2)
+        PaymentsUser.objects.create(reference="%s1" % name, subscribed_until=today, status=PAID_PAYMENT_STATUS,
+                                    price=120, tva=20, subscription=cls.subscription, product=cls.product, user=user)
+        if card:
+            SaveCardUser.objects.create(first_name="g", last_name="t", card_id=name, user=user,
+                                        card_exp_date=today + datetime.timedelta(100))
+        return user
+
+    @staticmethod
+    def payplug_response(**data):
+        return MockResponse({"id": "pay_%s" % data["metadata"]["token"]})
+
+    def test_load_due_renewals(self):
+        with self.assertNumQueries(3):
+            renewals = load_due_renewals()
+
+        self.assertEqual([renewal.user for renewal in renewals], self.users)
+        self.assertEqual(renewals[0].card.card_id, "a")
+        self.assertEqual(renewals[0].product, self.product)
+        self.assertEqual(renewals[0].subscription, self.subscription)
+
+    def test_load_due_renewals_without_duplicate(self):
+        PaymentsUser.objects.create(reference="a2", subscribed_until=datetime.date.today(),
+                                    status=PAID_PAYMENT_STATUS, price=120, tva=20, subscription=self.subscription,
+                                    product=self.product, user=self.users[0])
+        renewals = load_due_renewals()
+        self.assertEqual(len(renewals), 3)
+
+    def test_load_due_renewals_without_card(self):
+        user = self.create_member("d", card=False)
+        renewals = load_due_renewals()
+        user.refresh_from_db()
+
+        self.assertEqual(len(renewals), 3)
+        self.assertEqual(user.accreditation, 1)
+
+    @patch("payplug.Payment.create")
+    def test_find_recurring_payments(self, payment_mock):
+        payment_mock.side_effect = self.payplug_response
+        # 3 to load the renewals, then a savepoint around the insert and the update of the users
+        with self.assertNumQueries(7):
+            report = find_recurring_payments()
+
+        self.assertEqual(report.users, 3)
+        self.assertEqual(report.payments, 3)
+        self.assertEqual(payment_mock.call_count, 3)
+        until = datetime.date.today() + datetime.timedelta(self.product.duration)
+        for user in self.users:
+            self.assertEqual(user.payments.count(), 2)
+            user.refresh_from_db()
+            self.assertEqual(user.active_until, until)
+            self.assertEqual(user.current_product, self.product)
+
+    @patch("payplug.Payment.create")
+    def test_find_recurring_payments_twice(self, payment_mock):
+        payment_mock.side_effect = self.payplug_response
+        find_recurring_payments()
+        report = find_recurring_payments()
+
+        self.assertEqual(report.users, 0)
+        self.assertEqual(payment_mock.call_count, 3)
+        self.assertEqual([user.payments.count() for user in self.users], [2, 2, 2])
+
+        PaymentsUser.objects.filter(reference__startswith="pay_").update(status=PAID_PAYMENT_STATUS)
+        self.assertEqual(find_recurring_payments().users, 0)  # Once notified
+        self.assertEqual(payment_mock.call_count, 3)
+
+    @patch("payplug.Payment.create")
+    def test_find_recurring_payments_flushed_by_chunks(self, payment_mock):
+        payment_mock.side_effect = self.payplug_response
+        with CaptureQueriesContext(connection) as queries:
+            report = find_recurring_payments(executor=PayplugExecutor(max_workers=1), flush_size=2)
+        inserts = [query for query in queries if query["sql"].startswith("INSERT")]
+
+        self.assertEqual(report.payments, 3)
+        self.assertEqual(len(inserts), 2)
+
+    @patch("payplug.Payment.create")
+    def test_find_recurring_payments_failed_chunk(self, payment_mock):
+        def bulk_create(objs, *args, **kwargs):
+            if any(payment.user == self.users[1] for payment in objs):
+                raise IntegrityError("UNIQUE constraint failed: account_paymentsuser.reference")
+            return create(objs, *args, **kwargs)
+
+        payment_mock.side_effect = self.payplug_response
+        create = PaymentsUser.objects.bulk_create
+        with patch.object(PaymentsUser.objects, "bulk_create", side_effect=bulk_create):
+            report = find_recurring_payments(executor=PayplugExecutor(max_workers=1), flush_size=1)
+
+        self.assertEqual(report.payments, 2)
+        self.assertEqual(len(report.errors), 1)
+        self.assertEqual(report.errors[0][0].user, self.users[1])
+        self.assertIsInstance(report.errors[0][1], IntegrityError)
+        self.assertEqual([user.payments.count() for user in self.users], [2, 1, 2])
+        self.users[1].refresh_from_db()
+        self.assertIsNone(self.users[1].active_until)
+
+    @patch("payplug.Payment.create")
+    def test_find_recurring_payments_refused(self, payment_mock):
+        payment_mock.return_value = MockResponse({"is_paid": False})
+        report = find_recurring_payments()
+
+        self.assertEqual(report.users, 3)
+        self.assertEqual(report.payments, 0)
+        self.assertEqual(PaymentsUser.objects.count(), 3)
+
+    @patch("payplug.Payment.create")
+    def test_find_recurring_payments_with_error(self, payment_mock):
+        def payplug_response(**data):
+            if data["customer"]["email"] == "b@test.com":
+                raise payplug.exceptions.BadRequest()
+            return self.payplug_response(**data)
+
+        payment_mock.side_effect = payplug_response
+        report = find_recurring_payments(executor=PayplugExecutor(retries=0))
+
+        self.assertEqual(report.payments, 2)
+        self.assertEqual(len(report.errors), 1)
+        self.assertEqual(report.errors[0][0].user, self.users[1])
+        self.assertEqual(self.users[1].payments.count(), 1)
+
+
+class TestPayplugExecutor(TestCase):
+    """
+       Tests of executor.py --> PayplugExecutor
+    """
+
+    def test_concurrency_limit(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def call(item):
+            with lock:
+                running.append(item)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(item)
+            return item * 2
+
+        outcomes = list(PayplugExecutor(max_workers=3).map(call, range(10)))
+
+        self.assertEqual(sorted(outcome.result for outcome in outcomes), list(range(0, 20, 2)))
+        self.assertLessEqual(max(peak), 3)
+        self.assertGreater(max(peak), 1)
+
+    @staticmethod
+    def create_payment(url):
+        return lambda item: payplug.network.HttpClient().post(url, {"amount": 100})
+
+    def test_retry(self):
+        calls = []
+        refused = requests.exceptions.ConnectionError(MaxRetryError(None, "/", NewConnectionError(None, "refused")))
+
+        def call(item):
+            calls.append(item)
+            if len(calls) < 3:
+                raise payplug.exceptions.ClientError("network", client_exception=refused)
+            return item
+
+        outcomes = list(PayplugExecutor(retries=2, backoff=0.001).map(call, ["a"]))
+
+        self.assertEqual(outcomes[0].result, "a")
+        self.assertIsNone(outcomes[0].error)
+        self.assertEqual(len(calls), 3)
+
+    def test_no_retry_on_refused_payment(self):
+        calls = []
+
+        def call(item):
+            calls.append(item)
+            raise payplug.exceptions.BadRequest()
+
+        outcomes = list(PayplugExecutor(retries=2, backoff=0.001).map(call, ["a"]))
+
+        self.assertIsInstance(outcomes[0].error, payplug.exceptions.BadRequest)
+        self.assertEqual(len(calls), 1)
+
+    def test_no_retry_once_sent(self):
+        for error in (payplug.exceptions.PayPlugServerError(), payplug.exceptions.ClientError("network")):
+            calls = []
+
+            def call(item):
+                calls.append(item)
+                raise error
+
+            outcomes = list(PayplugExecutor(retries=2, backoff=0.001).map(call, ["a"]))
+            self.assertIs(outcomes[0].error, error)
+            self.assertEqual(len(calls), 1)
+
+    def test_no_retry_on_dropped_connection(self):
+        with FakePayplugServer(drop=True) as server:
+            url = payplug.routes.url(payplug.routes.PAYMENT_RESOURCE)
+            outcomes = list(PayplugExecutor(retries=2, backoff=0.001).map(self.create_payment(url), ["a"]))
+
+        self.assertIsInstance(outcomes[0].error, payplug.exceptions.ClientError)
+        self.assertFalse(is_never_sent(outcomes[0].error))
+        self.assertEqual(len(server.charges), 1)  # Charged once, left to be checked by hand
+
+    def test_retry_on_refused_connection(self):
+        with FakePayplugServer():
+            url = payplug.routes.url(payplug.routes.PAYMENT_RESOURCE)  # Nothing listens on it once closed
+        with patch.object(payplug.network.HttpClient, "post", autospec=True,
+                          side_effect=payplug.network.HttpClient.post) as post_mock:
+            outcomes = list(PayplugExecutor(retries=2, backoff=0.001).map(self.create_payment(url), ["a"]))
+
+        self.assertTrue(is_never_sent(outcomes[0].error))
+        self.assertEqual(post_mock.call_count, 3)
+
+    def test_timeout(self):
+        def call(item):
+            if item == "slow":
+                time.sleep(0.5)
+            return item
+
+        outcomes = list(PayplugExecutor(timeout=0.1).map(call, ["slow", "fast"]))
+        errors = {outcome.item: outcome.error for outcome in outcomes}
+
+        self.assertIsNone(errors["fast"])
+        self.assertIsInstance(errors["slow"], futures.TimeoutError)
+
+
 class TestApiChecks(TestCase):
     """
         Tests of api_payplug.py --> chechs()
@@ -541,8 +1308,8 @@ class TestApiChecks(TestCase):
 
     @patch('payplug.notifications.treat')
     def create_payment(self, treat_mock, user=None, date=50):
-        product = Product.objects.create(name="test", description="rien", price=120, tva=20, ht=100,
-                                         recurrent=True, duration=date, subscription=self.subscription)
+        product, _ = Product.objects.get_or_create(name="test%d" % date, subscription=self.subscription, defaults={
+            "description": "rien", "price": 120, "tva": 20, "ht": 100, "recurrent": True, "duration": date})
         create_classic_payment(user=user, subscription=self.subscription, product=product)
         self.payment = user.payments.all().order_by("-id")[0]
         self.payment.token = Token
@@ -555,6 +1322,7 @@ class TestApiChecks(TestCase):
 
         request = self.factory.post(reverse(u"notifications"))
         notifications_payplug_view(request)
+        process_notifications()
 
         user.refresh_from_db()
         self.payment.refresh_from_db()
@@ -612,3 +1380,266 @@ class TestApiChecks(TestCase):
 
         self.assertEqual(self.user1.accreditation, 1)
         self.assertEqual(self.user2.accreditation, 1)
+
+    def test_check_with_newer_valid_subscription(self):
+        self.create_payment(user=self.user1, date=-1)
+        self.create_payment(user=self.user1)
+        checks()
+        self.user1.refresh_from_db()
+
+        self.assertEqual(self.user1.accreditation, 2)
+
+    def test_reports(self):
+        self.create_payment(user=self.user1, date=-1)
+        cards, users = checks()
+
+        self.assertEqual((cards.name, cards.rows), ("cards", 0))
+        self.assertEqual((users.name, users.rows), ("accreditations", 1))
+
+
+class TestSweep(TestCase):
+    """
+        Tests of sweep.py --> sweep()
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username="c", email="test@test.com", password="passpass", accreditation=2)
+        date = datetime.date.today() - datetime.timedelta(1)
+        cls.cards = [SaveCardUser.objects.create(first_name="g", last_name="t", card_id=str(i), card_exp_date=date,
+                                                 card_available=True, user=user) for i in range(5)]
+
+    @staticmethod
+    def run_sweep(batch_size=2):
+        return sweep("cards", SaveCardUser.objects.filter(card_available=True), {"card_available": False}, batch_size)
+
+    def test_chunks(self):
+        report = self.run_sweep()
+
+        self.assertEqual(report.rows, 5)
+        self.assertEqual(report.chunks, 3)
+        self.assertEqual(report.resumed_from, 0)
+        self.assertGreater(report.seconds, 0)
+        self.assertFalse(SaveCardUser.objects.filter(card_available=True).exists())
+
+    def test_queries(self):
+        # Creation of the checkpoint, 5 per chunk (select, savepoint, checkpoint, update, release), empty select, reset
+        with self.assertNumQueries(4 + 3 * 5 + 2):
+            self.run_sweep()
+
+    def test_resume(self):
+        SweepCheckpoint.objects.create(name="cards", last_pk=self.cards[2].pk)
+        report = self.run_sweep()
+
+        self.assertEqual(report.rows, 2)
+        self.assertEqual(report.resumed_from, self.cards[2].pk)
+        self.assertEqual(SaveCardUser.objects.filter(card_available=True).count(), 3)
+
+    def test_checkpoint_reset(self):
+        self.run_sweep()
+        checkpoint = SweepCheckpoint.objects.get(name="cards")
+
+        self.assertEqual(checkpoint.last_pk, 0)
+        self.assertIsNotNone(checkpoint.finished)
+
+    def test_checkpoint_saved_with_chunk(self):
+        def interrupt(queryset, **values):
+            if queryset.model is SaveCardUser:
+                chunks.append(values)
+                if len(chunks) == 2:  # Stopped while writing the second chunk
+                    raise KeyboardInterrupt
+            return update(queryset, **values)
+
+        chunks = []
+        update = QuerySet.update
+        with patch.object(QuerySet, "update", autospec=True, side_effect=interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_sweep()
+
+        self.assertEqual(SweepCheckpoint.objects.get(name="cards").last_pk, self.cards[1].pk)
+        self.assertEqual(SaveCardUser.objects.filter(card_available=True).count(), 3)
+        self.assertEqual(self.run_sweep().resumed_from, self.cards[1].pk)
+
+    def test_repr(self):
+        report = self.run_sweep()
+
+        self.assertIn("rows=5", repr(report))
+        self.assertIn("lock_wait=", repr(report))
+
+
+def fake_task(rows=3, fail=False):
+    if fail:
+        raise ValueError("failed")
+    return rows
+
+
+FAKE_JOBS = {
+    "fake": {"task": "payment.tests.fake_task", "schedule": "* * * * *"},
+    "failing": {"task": "payment.tests.fake_task", "schedule": "0 2 * * *", "kwargs": {"fail": True}},
+}
+
+
+class TestCronSchedule(TestCase):
+    """
+        Tests of scheduler.py --> CronSchedule
+    """
+
+    @staticmethod
+    def local(*args):
+        return timezone.make_aware(datetime.datetime(*args))
+
+    def test_fields(self):
+        schedule = CronSchedule("*/15 1-3 1,15 * 7")
+
+        self.assertEqual(schedule.minutes, {0, 15, 30, 45})
+        self.assertEqual(schedule.hours, {1, 2, 3})
+        self.assertEqual(schedule.days, {1, 15})
+        self.assertEqual(schedule.months, set(range(1, 13)))
+        self.assertEqual(schedule.weekdays, {0})
+
+    def test_invalid(self):
+        for expression in ("* * * *", "60 * * * *", "* 5-2 * * *", "*/0 * * * *", "a * * * *"):
+            with self.assertRaises(ValueError):
+                CronSchedule(expression)
+
+    def test_next_after(self):
+        schedule = CronSchedule("0 2 * * *")
+
+        self.assertEqual(schedule.next_after(self.local(2017, 11, 13, 10, 0)), self.local(2017, 11, 14, 2, 0))
+        self.assertEqual(schedule.next_after(self.local(2017, 11, 14, 1, 59, 30)), self.local(2017, 11, 14, 2, 0))
+        self.assertEqual(schedule.next_after(self.local(2017, 11, 14, 2, 0)), self.local(2017, 11, 15, 2, 0))
+
+    def test_next_after_weekday(self):
+        schedule = CronSchedule("30 9 * * 1")  # Mondays
+
+        self.assertEqual(schedule.next_after(self.local(2017, 11, 13, 10, 0)), self.local(2017, 11, 20, 9, 30))
+
+    def test_next_after_day_or_weekday(self):
+        schedule = CronSchedule("0 0 13 * 5")  # The 13th, and the fridays
+
+        self.assertEqual(schedule.next_after(self.local(2017, 11, 11, 0, 0)), self.local(2017, 11, 13, 0, 0))
+        self.assertEqual(schedule.next_after(self.local(2017, 11, 13, 0, 0)), self.local(2017, 11, 17, 0, 0))
+
+    def test_next_after_month(self):
+        schedule = CronSchedule("0 0 29 2 *")
+
+        self.assertEqual(schedule.next_after(self.local(2017, 11, 13, 0, 0)), self.local(2020, 2, 29, 0, 0))
+        with self.assertRaises(ValueError):
+            CronSchedule("0 0 31 2 *").next_after(self.local(2017, 11, 13, 0, 0))
+
+    def test_next_after_clock_change(self):
+        schedule = CronSchedule("30 2 * * *")  # 2:30 doesn't exist on the 25th of march 2018 in Paris
+
+        self.assertIsNotNone(schedule.next_after(self.local(2018, 3, 24, 12, 0)))
+
+    def test_settings_jobs(self):
+        jobs = {job.name: job for job in get_jobs()}
+
+        self.assertIs(jobs["checks"].task, checks)
+        self.assertIs(jobs["recurring_payments"].task, find_recurring_payments)
+        self.assertEqual(jobs["purge_expired_tokens"].args, ["purge_expired_tokens"])
+
+    def test_jitter(self):
+        job = Job("fake", fake_task, "0 2 * * *", jitter=60)
+        moment = self.local(2017, 11, 13, 10, 0)
+        for _ in range(10):
+            delay = (job.next_run(moment) - self.local(2017, 11, 14, 2, 0)).total_seconds()
+            self.assertTrue(0 <= delay <= 60)
+
+
+@override_settings(SCHEDULER_JOBS=FAKE_JOBS)
+class TestScheduler(TestCase):
+    """
+        Tests of scheduler.py and of the run_scheduler command
+    """
+
+    def setUp(self):
+        # Closing the connection would end the transaction of the test
+        patcher = patch("payment.management.commands.run_scheduler.close_old_connections")
+        self.close_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_job(self):
+        run = run_job(Job("fake", "payment.tests.fake_task", "* * * * *"))
+
+        self.assertEqual(run.status, JobRun.DONE)
+        self.assertEqual(run.rows, 3)
+        self.assertIsNotNone(run.duration)
+        self.assertIsNotNone(run.finished)
+        self.assertFalse(JobLock.objects.exists())
+
+    def test_run_job_error(self):
+        run = run_job(Job("fake", fake_task, "* * * * *", kwargs={"fail": True}))
+
+        self.assertEqual(run.status, JobRun.ERROR)
+        self.assertEqual(run.error_message, "ValueError: failed")
+        self.assertFalse(JobLock.objects.exists())
+
+    def test_overlap(self):
+        JobLock.objects.create(name="fake", acquired=timezone.now(), owner="other:1")
+
+        self.assertIsNone(run_job(Job("fake", fake_task, "* * * * *")))
+        self.assertFalse(JobRun.objects.exists())
+
+    def test_stale_lock(self):
+        acquired = timezone.now() - datetime.timedelta(days=1)
+        JobLock.objects.create(name="fake", acquired=acquired, owner="other:1")
+
+        self.assertTrue(acquire_lock("fake", "me:1", timeout=3600))
+        self.assertEqual(JobLock.objects.get(name="fake").owner, "me:1")
+        self.assertFalse(acquire_lock("fake", "other:1", timeout=3600))
+
+    def test_summarize(self):
+        report = RenewalReport(users=3, payments=2, errors=[(None, ValueError())])
+
+        self.assertEqual(summarize(5), (5, 0))
+        self.assertEqual(summarize(None), (None, 0))
+        self.assertEqual(summarize(report), (2, 1))
+        self.assertEqual(summarize([report, None, SweepReport("cards", rows=4)]), (6, 1))
+
+    def test_is_slow(self):
+        for duration in (1, 2, 3):
+            JobRun.objects.create(name="fake", started=timezone.now(), duration=duration, status=JobRun.DONE)
+        run = JobRun.objects.create(name="fake", started=timezone.now(), duration=5, status=JobRun.DONE)
+
+        self.assertTrue(is_slow(run))
+        run.duration = 3
+        self.assertFalse(is_slow(run))
+        self.assertFalse(is_slow(JobRun.objects.earliest("pk")))
+
+    def test_command_once(self):
+        out, err = StringIO(), StringIO()
+        call_command("run_scheduler", "--once", stdout=out, stderr=err)
+
+        self.assertEqual(JobRun.objects.filter(status=JobRun.DONE).count(), 1)
+        self.assertEqual(JobRun.objects.filter(status=JobRun.ERROR).count(), 1)
+        self.assertIn("fake", out.getvalue())
+        self.assertIn("rows=3", out.getvalue())
+        self.assertIn("failing failed: ValueError: failed", err.getvalue())
+
+    def test_command_job(self):
+        call_command("run_scheduler", "fake", "--once", stdout=StringIO())
+
+        self.assertEqual(list(JobRun.objects.values_list("name", flat=True)), ["fake"])
+        self.assertEqual(self.close_mock.call_count, 2)  # Before and after the run
+        with self.assertRaises(CommandError):
+            call_command("run_scheduler", "unknown", "--once")
+
+    def test_command_history(self):
+        call_command("run_scheduler", "fake", "--once", stdout=StringIO())
+        out = StringIO()
+        call_command("run_scheduler", "--history", "5", stdout=out)
+
+        self.assertEqual(len(out.getvalue().splitlines()), 1)
+        self.assertEqual(JobRun.objects.count(), 1)
+
+    @patch("payment.management.commands.run_scheduler.time.sleep", side_effect=KeyboardInterrupt)
+    @patch("payment.scheduler.Job.next_run")
+    def test_command_loop(self, next_run_mock, sleep_mock):
+        now = timezone.now()
+        next_run_mock.side_effect = [now, now + datetime.timedelta(hours=1), now + datetime.timedelta(minutes=1)]
+        with self.assertRaises(KeyboardInterrupt):
+            call_command("run_scheduler", stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(list(JobRun.objects.values_list("name", flat=True)), ["failing"])
+        self.assertTrue(0 < sleep_mock.call_args[0][0] <= 60)
@@ -1,12 +1,11 @@
-import payplug
+from django.conf import settings
 from django.http import HttpResponseNotFound, HttpResponse, HttpResponseRedirect
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render
 from django.urls import reverse, reverse_lazy
 from django.views.decorators.csrf import csrf_exempt
 
-from payment.models import Product
-from .api_payplug import create_classic_payment, update_payment
-from .models import Subscription
+from .api_payplug import create_classic_payment, enqueue_notification
+from .catalogue import get_catalogue, find_product
 from account.api import accreditation_view_required
 
 
@@ -19,9 +18,9 @@ def subscription_view(request):
     :return: Render of the view
     """
     template_name = "payment/subscription.html"
-    subscriptions = Subscription.objects.all()
     return render(request, template_name, {
-        'subscriptions': subscriptions,
+        'subscriptions': get_catalogue(),
+        'catalogue_timeout': settings.CATALOGUE_CACHE_TIMEOUT,
     })
 
 
@@ -35,40 +34,37 @@ def payment_view(request, subscription_name, product):
     :param product: The product related to the payment
     :return: Redirect to the Payplug's site or an error 404
     """
-    subscription = get_object_or_404(Subscription, name=subscription_name)
+    product = find_product(subscription_name, product)  # From the cached catalogue, no query in the common case
+    if product is None:
+        return HttpResponseNotFound('<h1>Http 404</h1>')
+
+    payment = create_classic_payment(request.user, subscription=product.subscription, product=product,
+                                     data=get_payment_urls(request))
+    return HttpResponseRedirect(payment.hosted_payment.payment_url)
 
-    # Only with online sites
+
+def get_payment_urls(request):
+    """
+    The urls of the site given to Payplug with a payment. Only with online sites.
+    """
     return_url = request.build_absolute_uri(reverse("status"))
     cancel_url = request.build_absolute_uri(reverse("subscriptions"))
     notification_url = request.build_absolute_uri(reverse("notifications"))
-    hosted_payment = {'return_url': return_url, 'cancel_url': cancel_url}
-
-    # try/except 404
-    try:
-        product = subscription.products.get(name=product)
-    except Product.DoesNotExist:
-        return HttpResponseNotFound('<h1>Http 404</h1>')
-
-    payment = create_classic_payment(request.user, subscription=subscription, product=product, data={
-        'hosted_payment': hosted_payment,
+    return {
+        'hosted_payment': {'return_url': return_url, 'cancel_url': cancel_url},
         'notification_url': notification_url,
-    })
-    return HttpResponseRedirect(payment.hosted_payment.payment_url)
+    }
 
 
 @csrf_exempt  # Error without. Possible to improve it?
 def notifications_payplug_view(request):
     """
     A view without template, which receive Payplug's response by the notification_url, for the state of the payment.
+    The notification is only queued: the process_notifications command treats it.
     :param request: Request object
     :return: Code http 200
     """
-    try:
-        response = payplug.notifications.treat(request.body)  # Full api provide by payplug to manage the response
-    except payplug.exceptions.PayplugError:
-        return HttpResponse(400)
-    else:
-        update_payment(response)
+    enqueue_notification(request.body)
     return HttpResponse(200)
 
 